@@ -0,0 +1,295 @@
+"""Benchmark the Worker with synthetic jobs.
+
+Usage:
+    python bench_worker_redis.py [--broker memory|redis] [--jobs N] [--payload-size BYTES]
+                                 [--handler-latency SECONDS] [--rate JOBS_PER_SEC]
+                                 [--batch-sizes 1,10,100] [--batch-linger SECONDS]
+                                 [--max-in-flight N] [--memory] [--skewed]
+                                 [--host HOST] [--port PORT] [--db DB]
+    python bench_worker_redis.py --check
+
+Pushes --jobs messages through Worker.start for each batch size, handlers
+sleeping --handler-latency seconds, and reports:
+
+- jobs/sec,
+- CPU time per job, the worker's scheduling overhead when the handlers
+  only sleep (with --broker redis it includes the client side of redis),
+- the peak length of Worker._pending_tasks and, with --memory, the peak
+  traced memory (tracemalloc slows the run down),
+- the end-to-end latency percentiles from push to handler done.
+
+The queue is filled up front unless --rate is given, in which case a
+producer pushes at that rate while the worker runs; the latencies only
+mean something then. --broker memory (MemoryBroker) leaves out the
+network, --broker redis runs against a live redis. BATCH_SIZE=1 is the
+one-pop-per-message loop.
+
+--skewed fills a bulk queue with --jobs messages while a producer pushes
+to an interactive queue at --rate (100 by default), and reports the bulk
+jobs/sec and the interactive latency percentiles for plain BLPOP order
+(bulk first), QUEUE_WEIGHTS 1:1 and an interactive QUEUE_PRIORITIES level.
+
+--check runs backlogged queues through a MemoryBroker worker with
+QUEUE_WEIGHTS under a MAX_IN_FLIGHT smaller than a round of batches, and
+exits with status 1 when the jobs run per queue stray more than 10% from
+the weights.
+"""
+import argparse
+import array
+import asyncio
+import contextlib
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+from worker_redis import MemoryBroker, Worker
+
+QUEUE = 'bench_worker_redis'
+INTERACTIVE = 'bench_worker_redis_interactive'
+STAMP = struct.Struct('d')
+
+
+class BenchWorker(Worker):
+    peak_pending = 0
+
+    def schedule(self, *args, **kwargs):
+        super().schedule(*args, **kwargs)
+        if len(self._pending_tasks) > self.peak_pending:
+            self.peak_pending = len(self._pending_tasks)
+
+
+def make_messages(count, payload_size):
+    message = STAMP.pack(time.perf_counter()) + b'x' * max(payload_size - STAMP.size, 0)
+    return [message] * count
+
+
+async def fill(broker, jobs, payload_size, chunk=1000):
+    for start in range(0, jobs, chunk):
+        await broker.push(QUEUE, *make_messages(min(chunk, jobs - start), payload_size))
+
+
+async def produce(loop, broker, jobs, payload_size, rate, tick=0.01, queue=QUEUE):
+    pushed = 0
+    start = loop.time()
+    while pushed < jobs:
+        due = min(int((loop.time() - start + tick) * rate), jobs)
+        if due > pushed:
+            await broker.push(queue, *make_messages(due - pushed, payload_size))
+            pushed = due
+        await asyncio.sleep(tick, loop=loop)
+    return pushed
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+async def bench(loop, args, settings):
+    latencies = array.array('d')
+    done = 0
+    finished_at = None
+    handler_latency = args.handler_latency
+
+    async def handler(data):
+        nonlocal done, finished_at
+        if handler_latency:
+            await asyncio.sleep(handler_latency, loop=loop)
+        latencies.append(time.perf_counter() - STAMP.unpack_from(data)[0])
+        done += 1
+        if done == args.jobs:
+            finished_at = time.perf_counter()
+            worker._is_running = False
+
+    broker = MemoryBroker(loop=loop) if args.broker == 'memory' else None
+    worker = BenchWorker(loop=loop, worker_settings=settings, handlers={QUEUE: [handler]}, broker=broker)
+    if args.broker == 'redis':
+        async with await worker.get_redis_conn() as redis:
+            await redis.delete(QUEUE)
+    producer = None
+    if args.rate:
+        producer = loop.create_task(produce(loop, worker.broker, args.jobs, args.payload_size, args.rate))
+    else:
+        await fill(worker.broker, args.jobs, args.payload_size)
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await worker.start()
+    cpu = time.process_time() - cpu_start
+    peak_memory = None
+    if args.memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if producer is not None:
+        await producer
+    latencies = sorted(latencies)
+    return {
+        'jobs_per_sec': args.jobs / (finished_at - start),
+        'cpu_per_job': cpu / args.jobs,
+        'peak_pending': worker.peak_pending,
+        'peak_memory': peak_memory,
+        'latency': [percentile(latencies, q) for q in (0.5, 0.95, 0.99)],
+    }
+
+
+async def bench_skewed(loop, args, settings):
+    """
+    Drain a backlog of --jobs bulk messages while interactive messages
+    arrive at --rate, stop once both are done.
+    """
+    latencies = array.array('d')
+    counts = {QUEUE: 0, INTERACTIVE: 0}
+    interactive_jobs = max(int(args.rate * 0.5), 1)  # pushed during the first half second
+    finished = {}
+    handler_latency = args.handler_latency
+
+    def handler(queue_name, jobs):
+        async def handle(data):
+            if handler_latency:
+                await asyncio.sleep(handler_latency, loop=loop)
+            if queue_name == INTERACTIVE:
+                latencies.append(time.perf_counter() - STAMP.unpack_from(data)[0])
+            counts[queue_name] += 1
+            if counts[queue_name] == jobs:
+                finished[queue_name] = time.perf_counter()
+                if len(finished) == 2:
+                    worker._is_running = False
+        return handle
+
+    broker = MemoryBroker(loop=loop) if args.broker == 'memory' else None
+    # bulk first, that's the queue BLPOP serves first
+    handlers = {QUEUE: [handler(QUEUE, args.jobs)], INTERACTIVE: [handler(INTERACTIVE, interactive_jobs)]}
+    worker = Worker(loop=loop, worker_settings=settings, handlers=handlers, broker=broker)
+    if args.broker == 'redis':
+        async with await worker.get_redis_conn() as redis:
+            await redis.delete(QUEUE, INTERACTIVE)
+    await fill(worker.broker, args.jobs, args.payload_size)
+    start = time.perf_counter()
+    producer = loop.create_task(produce(loop, worker.broker, interactive_jobs, args.payload_size,
+                                        args.rate, queue=INTERACTIVE))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await worker.start()
+    await producer
+    latencies = sorted(latencies)
+    return {
+        'jobs_per_sec': args.jobs / (finished[QUEUE] - start),
+        'latency': [percentile(latencies, q) for q in (0.5, 0.95, 0.99)],
+    }
+
+
+def main_skewed(loop, args):
+    if not args.rate:
+        args.rate = 100
+    strategies = [
+        ('blpop order', {}),
+        ('weights 1:1', {'QUEUE_WEIGHTS': {QUEUE: 1, INTERACTIVE: 1}}),
+        ('priority', {'QUEUE_PRIORITIES': {INTERACTIVE: 1}}),
+    ]
+    batch_size = int(args.batch_sizes.split(',')[-1])
+    print('%-12s %14s %30s' % ('strategy', 'bulk jobs/sec', 'interactive p50/p95/p99 ms'))
+    for name, fair_settings in strategies:
+        settings = {
+            'HOST': args.host, 'PORT': args.port, 'DB': args.db,
+            'BATCH_SIZE': batch_size, 'BATCH_LINGER': args.batch_linger, 'POLL_TIMEOUT': 1,
+            'MAX_IN_FLIGHT': args.max_in_flight,
+        }
+        settings.update(fair_settings)
+        result = loop.run_until_complete(bench_skewed(loop, args, settings))
+        print('%-12s %14.0f %30s' % (
+            name, result['jobs_per_sec'], '/'.join('%.1f' % (latency * 1000) for latency in result['latency'])))
+
+
+async def check_weights(loop, weights, batch_size, max_in_flight, jobs=3000):
+    """
+    Run `jobs` jobs out of backlogged queues, the handlers of later queues
+    taking longer, return how many each queue ran.
+    """
+    counts = dict.fromkeys(weights, 0)
+
+    def handler(queue_name):
+        latency = 0.0005 * (1 + list(weights).index(queue_name))
+
+        async def handle(data):
+            await asyncio.sleep(latency, loop=loop)
+            counts[queue_name] += 1
+            if sum(counts.values()) == jobs:
+                worker._is_running = False
+        return handle
+
+    broker = MemoryBroker(loop=loop)
+    settings = {'BATCH_SIZE': batch_size, 'MAX_IN_FLIGHT': max_in_flight, 'QUEUE_WEIGHTS': weights,
+                'STATS_INTERVAL': 0}
+    worker = Worker(loop=loop, worker_settings=settings, broker=broker,
+                    handlers={queue_name: [handler(queue_name)] for queue_name in weights})
+    for queue_name in weights:
+        await broker.push(queue_name, *[b'x'] * jobs)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.wait_for(worker.poll(), 60, loop=loop)
+        if worker._pending_tasks:
+            await asyncio.wait(worker._pending_tasks, loop=loop)
+    return counts
+
+
+def main_check(loop):
+    failures = 0
+    for weights, batch_size, max_in_flight in [
+        ({'a': 1, 'b': 1, 'c': 1}, 5, 10),
+        ({'a': 2, 'b': 1, 'c': 1}, 10, 20),
+        ({'a': 3, 'b': 1}, 1, 1),
+    ]:
+        counts = loop.run_until_complete(check_weights(loop, weights, batch_size, max_in_flight))
+        total, weight_total = sum(counts.values()), sum(weights.values())
+        fair = all(abs(counts[queue_name] - total * weight / weight_total) <= total * weight / weight_total * 0.1
+                   for queue_name, weight in weights.items())
+        failures += not fair
+        print('%s weights %s, BATCH_SIZE %d, MAX_IN_FLIGHT %d: %s' % (
+            'ok    ' if fair else 'FAILED', ':'.join('%g' % weight for weight in weights.values()),
+            batch_size, max_in_flight, ':'.join('%d' % counts[queue_name] for queue_name in weights)))
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', choices=['memory', 'redis'], default='memory')
+    parser.add_argument('--jobs', type=int, default=100000)
+    parser.add_argument('--payload-size', type=int, default=64)
+    parser.add_argument('--handler-latency', type=float, default=0)
+    parser.add_argument('--rate', type=float, default=0, help='jobs/sec pushed while running, 0 fills up front')
+    parser.add_argument('--batch-sizes', default='1,10,100')
+    parser.add_argument('--batch-linger', type=float, default=0)
+    parser.add_argument('--max-in-flight', type=int, default=0)
+    parser.add_argument('--memory', action='store_true', help='trace the peak memory with tracemalloc')
+    parser.add_argument('--skewed', action='store_true', help='compare queue scheduling under a bulk backlog')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--check', action='store_true', help='check QUEUE_WEIGHTS under MAX_IN_FLIGHT')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if args.check:
+        return main_check(loop)
+    if args.skewed:
+        main_skewed(loop, args)
+        return 0
+    print('%10s %12s %12s %12s %10s %24s' % (
+        'batch size', 'jobs/sec', 'cpu us/job', 'peak pending', 'peak MB', 'e2e p50/p95/p99 ms'))
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        settings = {
+            'HOST': args.host, 'PORT': args.port, 'DB': args.db,
+            'BATCH_SIZE': batch_size, 'BATCH_LINGER': args.batch_linger, 'POLL_TIMEOUT': 1,
+            'MAX_IN_FLIGHT': args.max_in_flight,
+        }
+        result = loop.run_until_complete(bench(loop, args, settings))
+        print('%10d %12.0f %12.1f %12d %10s %24s' % (
+            batch_size, result['jobs_per_sec'], result['cpu_per_job'] * 1e6, result['peak_pending'],
+            '-' if result['peak_memory'] is None else '%.1f' % (result['peak_memory'] / 2 ** 20),
+            '/'.join('%.1f' % (latency * 1000) for latency in result['latency'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
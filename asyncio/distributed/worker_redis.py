@@ -2,8 +2,23 @@ import os
 import signal
 import asyncio
 import aioredis
+import binascii
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import socket
 import traceback
+import time
 import sys
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class CancelJob(Exception):
     pass
@@ -17,53 +32,859 @@ class HandledExit(Exception):
 class TerminateWorker(Exception):
     pass
 
+class CoalescedJob(Exception):
+    # Another worker holds the coalesce lock, the job runs there.
+    pass
+
+def cpu_bound(func):
+    """
+    Mark a plain (not async) handler as CPU-bound, run_job runs it in the
+    worker's process pool instead of on the event loop. It must be picklable,
+    i.e. defined at module level.
+    """
+    func.__cpu_bound__ = True
+    return func
+
+class Histogram:
+    """
+    Counts of observed durations in fixed buckets, cheap enough to update for
+    every job. Quantiles are estimated by interpolating inside a bucket.
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.BUCKETS):
+                    return self.BUCKETS[-1]
+                lower = self.BUCKETS[i - 1] if i else 0.0
+                return lower + (self.BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.BUCKETS[-1]
+
+
+class QueueStats:
+    __slots__ = ('wait_time', 'run_time', 'jobs_complete', 'jobs_failed', 'jobs_coalesced', 'depth',
+                 'jobs_per_sec', '_sampled_complete')
+
+    def __init__(self):
+        self.wait_time = Histogram()  # dequeued to handler started
+        self.run_time = Histogram()
+        self.jobs_complete = 0
+        self.jobs_failed = 0
+        self.jobs_coalesced = 0  # copies attached to a running job, or skipped for another worker's
+        self.depth = None  # LLEN of the queue, sampled every STATS_INTERVAL
+        self.jobs_per_sec = 0.0  # over the last STATS_INTERVAL
+        self._sampled_complete = 0
+
+
+class JsonCodec:
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(str(data, 'utf-8'))
+
+
+class MsgpackCodec:
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawCodec:
+    """Bytes in, a memoryview of them out, without copying."""
+    def encode(self, value):
+        return bytes(value)
+
+    def decode(self, data):
+        return memoryview(data)
+
+
+CODECS = {'json': JsonCodec(), 'raw': RawCodec()}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# First byte of an encoded payload.
+PLAIN = 0x00
+ZLIB = 0x01
+
+
+def get_codec(codec):
+    if not isinstance(codec, str):
+        return codec
+    if codec == 'msgpack' and msgpack is None:
+        raise ImportError('the msgpack codec needs the msgpack package')
+    return CODECS[codec]
+
+
+def encode_payload(value, codec='json', compress_threshold=1024):
+    """
+    Encode a message for a queue with a codec, zlib compressed when the
+    encoded value is longer than `compress_threshold` bytes (0 never
+    compresses) and that makes it shorter. Without a codec (None) the value
+    is returned as it is, for queues whose handlers take the message bytes.
+    """
+    if codec is None:
+        return value
+    body = get_codec(codec).encode(value)
+    if compress_threshold and len(body) > compress_threshold:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            return bytes((ZLIB,)) + compressed
+    return bytes((PLAIN,)) + body
+
+
+class Payload:
+    """
+    What handlers of a queue with a codec get instead of the message bytes.
+    `raw` (the decompressed bytes as a memoryview) and `value` (decoded by
+    the codec) are worked out on first access and shared by all handlers of
+    the message.
+    """
+    __slots__ = ('codec', 'data', '_raw', '_value')
+
+    _missing = object()
+
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.data = data
+        self._raw = None
+        self._value = self._missing
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            view = memoryview(self.data)
+            if view[0] == PLAIN:
+                self._raw = view[1:]
+            elif view[0] == ZLIB:
+                self._raw = memoryview(zlib.decompress(view[1:]))
+            else:
+                raise ValueError('Unknown payload header %#04x' % view[0])
+        return self._raw
+
+    @property
+    def value(self):
+        if self._value is self._missing:
+            self._value = self.codec.decode(self.raw)
+        return self._value
+
+    def __bytes__(self):
+        return bytes(self.raw)
+
+    def __reduce__(self):
+        # For @cpu_bound handlers, memoryviews don't pickle.
+        return Payload, (self.codec, bytes(self.data))
+
+
+class Coalesce:
+    """
+    QUEUE_COALESCE options of a queue. `key(payload)` names a job, the
+    message bytes by default. Handlers wait `debounce` seconds before they
+    start, and with a `ttl` the key is also locked in the broker for at most
+    that many seconds, so other workers skip their copies too.
+    """
+    __slots__ = ('key', 'debounce', 'ttl')
+
+    def __init__(self, key=None, debounce=0, ttl=0):
+        self.key = key
+        self.debounce = debounce
+        self.ttl = ttl
+
+
+class InFlightMessage:
+    """
+    A message whose handlers are running, done once the last one is. Copies
+    coalesced into it share its outcome. `interrupted` when a handler was
+    cancelled or stopped by HandledExit before it finished.
+    """
+    __slots__ = ('queue_name', 'data', 'handlers_left', 'failed', 'interrupted', 'coalesce_key', 'copies',
+                 'lock_token')
+
+    def __init__(self, queue_name, data, handlers_left):
+        self.queue_name = queue_name
+        self.data = data
+        self.handlers_left = handlers_left
+        self.failed = False
+        self.interrupted = False
+        self.coalesce_key = None
+        self.copies = []
+        self.lock_token = None
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+async def _create_redis_pool(settings, loop):
+    return await aioredis.create_pool(
+        (
+            settings['HOST'],
+            settings['PORT'],
+        ), loop=loop,
+        db=settings['DB'],
+        password=settings.get('PASSWORD'),
+    )
+
+def _init_pool_process():
+    # Ctrl-C reaches the whole process group, leave stopping the pool to the worker.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+class Broker:
+    """
+    The message queue under a Worker. Messages are bytes, queues are FIFO.
+    """
+    # Whether `ack` has to be called once all handlers of a message are done,
+    # brokers that forget messages as soon as they're popped don't need it.
+    needs_ack = False
+
+    async def pop(self, queues, count=1, timeout=0, linger=0):
+        """
+        Wait up to `timeout` seconds (0 is forever) for a message in any of
+        `queues`, the first non-empty one wins. Return (queue_name, messages)
+        with up to `count` messages (an int or a dict by queue name) of that
+        queue, or None on timeout. A short batch is topped up once more after
+        `linger` seconds.
+        """
+        raise NotImplementedError
+
+    async def pop_nowait(self, counts):
+        """
+        Pop up to `counts[queue_name]` messages of each queue without
+        waiting, return the messages by queue name.
+        """
+        raise NotImplementedError
+
+    async def push(self, queue_name, *messages):
+        """Append messages to the tail of a queue."""
+        raise NotImplementedError
+
+    async def push_many(self, items):
+        """`push` every (queue_name, messages) of `items`, in one round trip if possible."""
+        for queue_name, messages in items:
+            await self.push(queue_name, *messages)
+
+    async def requeue(self, queue_name, messages):
+        """Put popped messages back to the head of their queue, in order."""
+        raise NotImplementedError
+
+    async def ack(self, queue_name, message, failed=False):
+        """All handlers of a popped message are done, `failed` if any of them failed."""
+        pass
+
+    async def depth(self, queue_names):
+        """The number of messages waiting in each queue."""
+        raise NotImplementedError
+
+    async def lock(self, key, token, ttl):
+        """Set `key` to `token` for `ttl` seconds unless it's set already, True if it was set."""
+        raise NotImplementedError
+
+    async def unlock(self, key, token):
+        """Delete `key` if it's still set to `token`."""
+        raise NotImplementedError
+
+    async def start(self, queue_names):
+        """Called by Worker.start with the queues it consumes."""
+        pass
+
+    async def close(self):
+        pass
+
+
+class RedisBroker(Broker):
+    UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+    def __init__(self, settings: dict, *, loop: asyncio.AbstractEventLoop = None, pool_factory=None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.settings = settings
+        # A coroutine function returning the pool, e.g. Worker.create_redis_pool.
+        self.pool_factory = pool_factory
+        self._redis_pool = None
+
+    async def create_redis_pool(self) -> aioredis.RedisPool:
+        if self.pool_factory is not None:
+            return await self.pool_factory()
+        return await _create_redis_pool(self.settings, self.loop)
+
+    async def get_redis_pool(self) -> aioredis.RedisPool:
+        if self._redis_pool is None:
+            self._redis_pool = await self.create_redis_pool()
+        return self._redis_pool
+
+    async def get_redis_conn(self):
+        pool = await self.get_redis_pool()
+        return pool.get()
+
+    async def pop(self, queues, count=1, timeout=0, linger=0):
+        async with await self.get_redis_conn() as redis:
+            msg = await redis.blpop(*queues, timeout=timeout)
+            if not msg:
+                return None
+            queue_name, data = msg
+            queue_name = queue_name.decode('utf-8')
+            messages = [data]
+            if isinstance(count, dict):
+                count = count.get(queue_name, 1)
+            if count > 1:
+                messages.extend(await self.drain(redis, queue_name, count - 1, linger))
+        return queue_name, messages
+
+    async def drain(self, redis, queue_name, count, linger=0):
+        """
+        Pop up to `count` more messages of `queue_name` without blocking, as
+        one pipeline of LPOPs on the connection BLPOP returned on.
+        """
+        messages = []
+        for attempt in range(2 if linger > 0 else 1):
+            if attempt:
+                await asyncio.sleep(linger, loop=self.loop)
+            pipe = redis.pipeline()
+            for _ in range(count - len(messages)):
+                pipe.lpop(queue_name)
+            messages.extend(data for data in await pipe.execute() if data is not None)
+            if len(messages) >= count:
+                break
+        return messages
+
+    async def pop_nowait(self, counts):
+        async with await self.get_redis_conn() as redis:
+            pipe = redis.pipeline()
+            for queue_name, count in counts.items():
+                for _ in range(count):
+                    pipe.lpop(queue_name)
+            results = await pipe.execute()
+        batches = {}
+        start = 0
+        for queue_name, count in counts.items():
+            batches[queue_name] = [data for data in results[start:start + count] if data is not None]
+            start += count
+        return batches
+
+    async def push(self, queue_name, *messages):
+        async with await self.get_redis_conn() as redis:
+            await redis.rpush(queue_name, *messages)
+
+    async def push_many(self, items):
+        async with await self.get_redis_conn() as redis:
+            pipe = redis.pipeline()
+            for queue_name, messages in items:
+                pipe.rpush(queue_name, *messages)
+            await pipe.execute()
+
+    async def requeue(self, queue_name, messages):
+        async with await self.get_redis_conn() as redis:
+            await redis.lpush(queue_name, *reversed(messages))
+
+    async def depth(self, queue_names):
+        async with await self.get_redis_conn() as redis:
+            pipe = redis.pipeline()
+            for queue_name in queue_names:
+                pipe.llen(queue_name)
+            return await pipe.execute()
+
+    async def lock(self, key, token, ttl):
+        async with await self.get_redis_conn() as redis:
+            return bool(await redis.set(key, token, pexpire=int(ttl * 1000), exist=redis.SET_IF_NOT_EXIST))
+
+    async def unlock(self, key, token):
+        async with await self.get_redis_conn() as redis:
+            await redis.eval(self.UNLOCK_SCRIPT, [key], [token])
+
+    async def close(self):
+        if self._redis_pool:
+            pool, self._redis_pool = self._redis_pool, None
+            pool.close()
+            await pool.wait_closed()
+            await pool.clear()
+
+
+class Delivery(bytes):
+    """
+    A message popped by a ReliableRedisBroker: the payload, plus the
+    `stored` form in its processing list and the delivery `attempts` so far.
+    """
+    stored = None
+    attempts = 0
+
+
+class ReliableRedisBroker(RedisBroker):
+    """
+    At-least-once delivery on redis. Popped messages move to a processing
+    list of this worker and stay there until they're acked. On failure they
+    wait in a sorted set (exponential backoff, RETRY_BACKOFF seconds times
+    2 ** attempts up to RETRY_BACKOFF_MAX) for the promoter to push them back
+    to their queue, after MAX_ATTEMPTS deliveries they go to a dead-letter
+    list instead. A worker refreshes a heartbeat key, once it's silent for
+    VISIBILITY_TIMEOUT seconds any other worker's reaper returns its
+    processing lists to the head of the queues.
+
+    Keys, for a queue `q`: `q:processing:<worker id>`, `q:workers`,
+    `q:delayed` and `q:dead`. Messages are stored behind a
+    \\x1e<attempts>:<token>\\x1e header (see `frame`), removed before
+    handlers see them, a message without a valid one is delivered as it is.
+
+    Once the queues are empty, `pop` waits in BLMOVE (redis 6.2) for the
+    next message of a single queue. With several queues it waits on each in
+    turn for up to `idle_interval` seconds, since BLMOVE takes one source.
+    """
+    needs_ack = True
+    idle_interval = 0.05
+    promote_batch = 100
+
+    RETRY_MARK = b'\x1e'
+
+    POP_SCRIPT = """
+local messages = {}
+for i = 1, tonumber(ARGV[1]) do
+    local message = redis.call('LPOP', KEYS[1])
+    if not message then break end
+    redis.call('RPUSH', KEYS[2], message)
+    messages[#messages + 1] = message
+end
+return messages
+"""
+
+    PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(due))
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return #due
+"""
+
+    RECOVER_SCRIPT = """
+local count = 0
+while redis.call('RPOPLPUSH', KEYS[1], KEYS[2]) do count = count + 1 end
+return count
+"""
+
+    REAP_SCRIPT = """
+if redis.call('EXISTS', KEYS[4]) == 1 then return -1 end
+local count = 0
+while redis.call('RPOPLPUSH', KEYS[1], KEYS[2]) do count = count + 1 end
+redis.call('SREM', KEYS[3], ARGV[1])
+return count
+"""
+
+    def __init__(self, settings: dict, *, loop: asyncio.AbstractEventLoop = None, pool_factory=None) -> None:
+        super().__init__(settings, loop=loop, pool_factory=pool_factory)
+        self.worker_id = settings.get('WORKER_ID') or '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), binascii.hexlify(os.urandom(4)).decode())
+        self.visibility_timeout = settings.get('VISIBILITY_TIMEOUT', 30)
+        self.max_attempts = settings.get('MAX_ATTEMPTS', 5)
+        self.retry_backoff = settings.get('RETRY_BACKOFF', 1)
+        self.retry_backoff_max = settings.get('RETRY_BACKOFF_MAX', 300)
+        self.promote_interval = settings.get('PROMOTE_INTERVAL', 1)
+        self.queue_names = []
+        self._retries = 0
+        self._maintenance_task = None
+
+    def processing_key(self, queue_name, worker_id=None):
+        return '%s:processing:%s' % (queue_name, worker_id or self.worker_id)
+
+    def heartbeat_key(self, worker_id=None):
+        return 'worker:%s:alive' % (worker_id or self.worker_id)
+
+    def frame(self, payload, attempts=0, token=b''):
+        """
+        The stored form of `payload`. Every message pushed gets the header,
+        so a payload starting with RETRY_MARK can't pass for one.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return b'%s%d:%s%s%s' % (self.RETRY_MARK, attempts, token, self.RETRY_MARK, bytes(payload))
+
+    def delivery(self, stored):
+        message = None
+        if stored.startswith(self.RETRY_MARK):
+            header, mark, payload = stored[1:].partition(self.RETRY_MARK)
+            attempts = header.split(b':', 1)[0]
+            if mark and attempts.isdigit():
+                message = Delivery(payload)
+                message.attempts = int(attempts)
+        if message is None:
+            # Pushed without the header (or a malformed one), by something else than a broker.
+            message = Delivery(stored)
+        message.stored = stored
+        return message
+
+    async def pop(self, queues, count=1, timeout=0, linger=0):
+        deadline = self.loop.time() + timeout if timeout else None
+        turn = 0
+        while True:
+            async with await self.get_redis_conn() as redis:
+                for queue_name in queues:
+                    n = count.get(queue_name, 1) if isinstance(count, dict) else count
+                    stored = await redis.eval(self.POP_SCRIPT, [queue_name, self.processing_key(queue_name)], [n])
+                    if stored:
+                        return queue_name, await self.fill(redis, queue_name, stored, n, linger)
+                wait = 0
+                if deadline is not None:
+                    wait = deadline - self.loop.time()
+                    if wait <= 0:
+                        return None
+                if len(queues) > 1:
+                    wait = min(wait, self.idle_interval) if wait else self.idle_interval
+                queue_name = queues[turn % len(queues)]
+                turn += 1
+                message = await redis.execute(b'BLMOVE', queue_name, self.processing_key(queue_name),
+                                              b'LEFT', b'RIGHT', wait)
+                if message is not None:
+                    n = count.get(queue_name, 1) if isinstance(count, dict) else count
+                    stored = [message]
+                    if n > 1:
+                        stored.extend(await redis.eval(
+                            self.POP_SCRIPT, [queue_name, self.processing_key(queue_name)], [n - 1]))
+                    return queue_name, await self.fill(redis, queue_name, stored, n, linger)
+
+    async def fill(self, redis, queue_name, stored, count, linger):
+        """Wait `linger` seconds for a short batch to fill up, returns its deliveries."""
+        if len(stored) < count and linger > 0:
+            await asyncio.sleep(linger, loop=self.loop)
+            stored.extend(await redis.eval(
+                self.POP_SCRIPT, [queue_name, self.processing_key(queue_name)], [count - len(stored)]))
+        return [self.delivery(message) for message in stored]
+
+    async def pop_nowait(self, counts):
+        async with await self.get_redis_conn() as redis:
+            pipe = redis.pipeline()
+            for queue_name, count in counts.items():
+                pipe.eval(self.POP_SCRIPT, [queue_name, self.processing_key(queue_name)], [count])
+            results = await pipe.execute()
+        return {queue_name: [self.delivery(message) for message in stored]
+                for queue_name, stored in zip(counts, results)}
+
+    async def ack(self, queue_name, message, failed=False):
+        stored = message.stored if isinstance(message, Delivery) else message
+        async with await self.get_redis_conn() as redis:
+            tr = redis.multi_exec()
+            tr.lrem(self.processing_key(queue_name), 1, stored)
+            if failed:
+                attempts = getattr(message, 'attempts', 0) + 1
+                if attempts >= self.max_attempts:
+                    tr.rpush('%s:dead' % queue_name, bytes(message))
+                else:
+                    self._retries += 1
+                    delay = min(self.retry_backoff * 2 ** (attempts - 1), self.retry_backoff_max)
+                    retry = self.frame(message, attempts, b'%s-%d' % (self.worker_id.encode('utf-8'), self._retries))
+                    tr.zadd('%s:delayed' % queue_name, time.time() + delay, retry)
+            await tr.execute()
+
+    async def push(self, queue_name, *messages):
+        await super().push(queue_name, *[self.frame(message) for message in messages])
+
+    async def push_many(self, items):
+        await super().push_many([(queue_name, [self.frame(message) for message in messages])
+                                 for queue_name, messages in items])
+
+    async def requeue(self, queue_name, messages):
+        async with await self.get_redis_conn() as redis:
+            tr = redis.multi_exec()
+            for message in messages:
+                tr.lrem(self.processing_key(queue_name), 1, message.stored)
+            tr.lpush(queue_name, *[message.stored for message in reversed(messages)])
+            await tr.execute()
+
+    async def heartbeat(self):
+        async with await self.get_redis_conn() as redis:
+            await redis.set(self.heartbeat_key(), b'1', pexpire=int(self.visibility_timeout * 1000))
+
+    async def promote(self):
+        """Push retries that are due back to their queues, returns how many."""
+        promoted = 0
+        async with await self.get_redis_conn() as redis:
+            for queue_name in self.queue_names:
+                while True:
+                    count = await redis.eval(self.PROMOTE_SCRIPT, ['%s:delayed' % queue_name, queue_name],
+                                             [time.time(), self.promote_batch])
+                    promoted += count
+                    if count < self.promote_batch:
+                        break
+        return promoted
+
+    async def reap(self):
+        """
+        Return the processing lists of workers whose heartbeat expired to the
+        head of their queues, returns how many messages were recovered.
+        """
+        recovered = 0
+        async with await self.get_redis_conn() as redis:
+            for queue_name in self.queue_names:
+                for worker_id in await redis.smembers('%s:workers' % queue_name):
+                    worker_id = worker_id.decode('utf-8')
+                    if worker_id == self.worker_id:
+                        continue
+                    keys = [self.processing_key(queue_name, worker_id), queue_name,
+                            '%s:workers' % queue_name, self.heartbeat_key(worker_id)]
+                    count = await redis.eval(self.REAP_SCRIPT, keys, [worker_id])
+                    if count > 0:
+                        print('Recovered %d messages of %s from dead worker %s' % (count, queue_name, worker_id))
+                        recovered += count
+        return recovered
+
+    async def recover(self):
+        """
+        Return the processing lists this worker id left behind (a restart
+        with a fixed WORKER_ID) to the head of their queues, returns how
+        many messages were recovered. Reapers skip a worker's own id.
+        """
+        recovered = 0
+        async with await self.get_redis_conn() as redis:
+            for queue_name in self.queue_names:
+                count = await redis.eval(self.RECOVER_SCRIPT, [self.processing_key(queue_name), queue_name])
+                if count > 0:
+                    print('Recovered %d messages of %s from a previous run of %s' % (
+                        count, queue_name, self.worker_id))
+                    recovered += count
+        return recovered
+
+    async def maintain(self):
+        """Heartbeat and promote every PROMOTE_INTERVAL seconds, reap every VISIBILITY_TIMEOUT / 2."""
+        interval = min(self.promote_interval, self.visibility_timeout / 3)
+        next_reap = self.loop.time()
+        while True:
+            try:
+                await self.heartbeat()
+                await self.promote()
+                if self.loop.time() >= next_reap:
+                    next_reap = self.loop.time() + self.visibility_timeout / 2
+                    await self.reap()
+            except Exception as e:
+                print('ReliableRedisBroker maintenance error ', str(e))
+            await asyncio.sleep(interval, loop=self.loop)
+
+    async def start(self, queue_names):
+        self.queue_names = list(queue_names)
+        await self.heartbeat()
+        await self.recover()
+        async with await self.get_redis_conn() as redis:
+            for queue_name in self.queue_names:
+                await redis.sadd('%s:workers' % queue_name, self.worker_id)
+        self._maintenance_task = self.loop.create_task(self.maintain())
+
+    async def close(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+            async with await self.get_redis_conn() as redis:
+                # Leave anything still unacked to the reapers of other workers.
+                unacked = 0
+                for queue_name in self.queue_names:
+                    count = await redis.llen(self.processing_key(queue_name))
+                    if not count:
+                        await redis.srem('%s:workers' % queue_name, self.worker_id)
+                    unacked += count
+                if not unacked:
+                    await redis.delete(self.heartbeat_key())
+        await super().close()
+
+
+class MemoryBroker(Broker):
+    """
+    In-process queues with the same semantics as RedisBroker, to run a
+    Worker without a redis server, e.g. to measure the worker's own overhead.
+    """
+    def __init__(self, *, loop: asyncio.AbstractEventLoop = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.queues = collections.defaultdict(collections.deque)
+        self._pushed = asyncio.Event(loop=self.loop)
+        self._locks = {}  # key: (token, expires at)
+
+    def _take(self, queue, count):
+        return [queue.popleft() for _ in range(min(count, len(queue)))]
+
+    async def pop(self, queues, count=1, timeout=0, linger=0):
+        deadline = self.loop.time() + timeout if timeout else None
+        while True:
+            for queue_name in queues:
+                queue = self.queues.get(queue_name)
+                if queue:
+                    if isinstance(count, dict):
+                        count = count.get(queue_name, 1)
+                    messages = self._take(queue, count)
+                    if len(messages) < count and linger > 0:
+                        await asyncio.sleep(linger, loop=self.loop)
+                        messages.extend(self._take(queue, count - len(messages)))
+                    return queue_name, messages
+            self._pushed.clear()
+            if deadline is None:
+                await self._pushed.wait()
+                continue
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self._pushed.wait(), remaining, loop=self.loop)
+            except asyncio.TimeoutError:
+                return None
+
+    async def pop_nowait(self, counts):
+        return {queue_name: self._take(self.queues[queue_name], count) for queue_name, count in counts.items()}
+
+    async def push(self, queue_name, *messages):
+        self.queues[queue_name].extend(messages)
+        self._pushed.set()
+
+    async def requeue(self, queue_name, messages):
+        self.queues[queue_name].extendleft(reversed(messages))
+        self._pushed.set()
+
+    async def depth(self, queue_names):
+        return [len(self.queues.get(queue_name, ())) for queue_name in queue_names]
+
+    async def lock(self, key, token, ttl):
+        held = self._locks.get(key)
+        if held is not None and held[1] > self.loop.time():
+            return False
+        self._locks[key] = (token, self.loop.time() + ttl)
+        return True
+
+    async def unlock(self, key, token):
+        held = self._locks.get(key)
+        if held is not None and held[0] == token:
+            del self._locks[key]
+
+
 class Worker:
     def __init__(self, *,
                  loop: asyncio.AbstractEventLoop = None,
                  worker_settings: dict = None,
-                 handlers: dict = {}
+                 handlers: dict = {},
+                 broker: Broker = None
                  ) -> None:
         self.loop = loop or getattr(self, 'loop', None) or asyncio.get_event_loop()
         self.worker_settings = worker_settings or {}
-        self._worker_redis_pool = None
+        if broker is None:
+            # ACK: at-least-once delivery, see ReliableRedisBroker.
+            broker_class = ReliableRedisBroker if self.worker_settings.get('ACK') else RedisBroker
+            broker = broker_class(self.worker_settings, loop=self.loop, pool_factory=self.create_redis_pool)
+        self.broker = broker
+        self._broker_tasks = set()
         self._is_running = True
         signal.signal(signal.SIGINT, self.handle_sig)
         signal.signal(signal.SIGTERM, self.handle_sig)
-        signal.signal(signal.SIGUSR1, self.handle_sig_usr)
+        # Runs from the loop, printing the stats from a raw signal handler
+        # could interrupt a job in the middle of a print.
+        self.loop.add_signal_handler(signal.SIGUSR1, self.handle_sig_usr, signal.SIGUSR1, None)
         self._task_exception = None
         self.__handlers = handlers
         self._pending_tasks = set()  # type: set(asyncio.futures.Future)
         self.jobs_complete = 0
         self.jobs_failed = 0
+        self.jobs_coalesced = 0
+        # Pop up to BATCH_SIZE messages per round trip, waiting up to
+        # BATCH_LINGER seconds for a short batch to fill up.
+        self.batch_size = self.worker_settings.get('BATCH_SIZE', 1)
+        self.batch_linger = self.worker_settings.get('BATCH_LINGER', 0)
+        # BLPOP timeout, 0 blocks until a message arrives.
+        self.poll_timeout = self.worker_settings.get('POLL_TIMEOUT', 0)
+        # BLPOP timeout while a queue is left out for its in-flight limit, so
+        # poll gets back to it soon after a slot frees up.
+        self.limited_poll_timeout = self.worker_settings.get('LIMITED_POLL_TIMEOUT', 1)
+        # Limits on running jobs, in total and per queue (0 is unlimited).
+        # poll stops popping once they are reached and at most PREFETCH
+        # messages per limit wait in memory, the rest stays in redis.
+        self.max_in_flight = self.worker_settings.get('MAX_IN_FLIGHT', 0)
+        self.queue_max_in_flight = self.worker_settings.get('QUEUE_MAX_IN_FLIGHT', {})
+        self.prefetch = self.worker_settings.get('PREFETCH', 0)
+        # With either set, poll takes turns between the queues: a queue of a
+        # higher priority level is always served first, queues of the same
+        # level get BATCH_SIZE * weight messages per round (deficit
+        # round-robin). Without them BLPOP serves the first non-empty queue.
+        self.queue_weights = self.worker_settings.get('QUEUE_WEIGHTS', {})
+        self.queue_priorities = self.worker_settings.get('QUEUE_PRIORITIES', {})
+        self.in_flight = 0
+        self.queue_in_flight = {queue_name: 0 for queue_name in handlers}
+        self._prefetched = {queue_name: collections.deque() for queue_name in handlers}
+        self._capacity = asyncio.Event(loop=self.loop)
+        # Size of the process pool for @cpu_bound handlers, None is one
+        # process per core.
+        self.process_pool_size = self.worker_settings.get('PROCESS_POOL_SIZE')
+        self._process_pool = None
+        # Codecs by queue name, handlers of those queues get a Payload.
+        # Other queues keep passing the message bytes as they are.
+        self.queue_codecs = {queue_name: get_codec(codec)
+                             for queue_name, codec in self.worker_settings.get('QUEUE_CODECS', {}).items()}
+        self.compress_threshold = self.worker_settings.get('COMPRESS_THRESHOLD', 1024)
+        # Queues where a copy of a message whose job is running (same
+        # Coalesce.key) attaches to that job instead of running again, see
+        # start_message.
+        self.queue_coalesce = {queue_name: Coalesce(**options) if isinstance(options, dict) else Coalesce()
+                               for queue_name, options in self.worker_settings.get('QUEUE_COALESCE', {}).items()
+                               if options}
+        self._coalescing = {}  # (queue name, key): InFlightMessage
+        self._lock_prefix = '%s:%d:%s' % (socket.gethostname(), os.getpid(), binascii.hexlify(os.urandom(4)).decode())
+        self._locks_taken = 0
+        # Per queue metrics, served in the Prometheus text format on
+        # STATS_ADDRESS (a (host, port) tuple or a unix socket path) and
+        # printed on SIGUSR1. Queue depths and jobs/sec are sampled every
+        # STATS_INTERVAL seconds.
+        self.stats = {queue_name: QueueStats() for queue_name in handlers}
+        self.stats_address = self.worker_settings.get('STATS_ADDRESS')
+        self.stats_interval = self.worker_settings.get('STATS_INTERVAL', 10)
+        self._stats_server = None
+        self._stats_task = None
+        self._started_at = time.time()
         self._shutdown_lock = asyncio.Lock(loop=self.loop)
 
     async def create_redis_pool(self) -> aioredis.RedisPool:
-        return await aioredis.create_pool(
-            (
-                self.worker_settings['HOST'],
-                self.worker_settings['PORT'],
-            ), loop=self.loop,
-            db=self.worker_settings['DB'],
-            password=self.worker_settings.get('PASSWORD'),
-        )
+        """The pool of the RedisBroker this worker builds, override it to connect differently."""
+        return await _create_redis_pool(self.worker_settings, self.loop)
 
     async def get_redis_pool(self) -> aioredis.RedisPool:
-        if self._worker_redis_pool is None:
-            self._worker_redis_pool = await self.create_redis_pool()
-        return self._worker_redis_pool
+        return await self.broker.get_redis_pool()
 
     async def get_redis_conn(self):
-        pool = await self.get_redis_pool()
-        return pool.get()
+        return await self.broker.get_redis_conn()
+
+    def get_process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                self.process_pool_size, initializer=_init_pool_process)
+        return self._process_pool
 
     async def close(self):
-        if self._worker_redis_pool:
-            self._worker_redis_pool.close()
-            await self._worker_redis_pool.wait_closed()
-            await self._worker_redis_pool.clear()
+        self.loop.remove_signal_handler(signal.SIGUSR1)
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+        if self._stats_server is not None:
+            self._stats_server.close()
+            await self._stats_server.wait_closed()
+            self._stats_server = None
+        await self.broker.close()
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
 
     def handle_sig_usr(self, signum, frame):
-        self.handle_sig(signum, frame)  # TODO: make some changes!!
+        print(self.format_stats())
 
     def handle_sig(self, signum, frame):
         self._is_running = False  # Stop poll from redis
@@ -81,22 +902,295 @@ class Worker:
         raise ImmediateExit(
             'Warning: force exit, %d tasks are died.' % len(list(filter(lambda x: not x.done(), self._pending_tasks))))
 
+    @property
+    def prefetched(self):
+        return sum(len(messages) for messages in self._prefetched.values())
+
+    def pull_limit(self, queue_name=None):
+        """
+        How many more messages (of `queue_name`) poll may pop before the
+        in-flight limits plus the prefetch buffer are used up, None when
+        unlimited.
+        """
+        limits = []
+        if self.max_in_flight:
+            limits.append(self.max_in_flight + self.prefetch - self.in_flight - self.prefetched)
+        queue_limit = self.queue_pull_limit(queue_name)
+        if queue_limit is not None:
+            limits.append(queue_limit)
+        return min(limits) if limits else None
+
+    def queue_pull_limit(self, queue_name):
+        """pull_limit of `queue_name` from its QUEUE_MAX_IN_FLIGHT alone."""
+        queue_max = self.queue_max_in_flight.get(queue_name)
+        if not queue_max:
+            return None
+        return queue_max + self.prefetch - self.queue_in_flight[queue_name] - len(self._prefetched[queue_name])
+
+    def can_pull(self, queue_name):
+        limit = self.pull_limit(queue_name)
+        return limit is None or limit > 0
+
+    def pop_timeout(self, queues):
+        """
+        The timeout of a blocking pop on `queues`. While a queue is left out
+        for its in-flight limit, only the pop returning lets poll pull from it
+        again, so the pop mustn't block for longer than LIMITED_POLL_TIMEOUT.
+        """
+        if len(queues) == len(self.__handlers):
+            return self.poll_timeout
+        if self.poll_timeout:
+            return min(self.poll_timeout, self.limited_poll_timeout)
+        return self.limited_poll_timeout
+
     async def poll(self):
-        mq_list = self.__handlers.keys()
+        if self.queue_weights or self.queue_priorities:
+            return await self.poll_fair()
+        mq_list = list(self.__handlers.keys())
         while self._is_running:
-            async with await self.get_redis_conn() as redis:
-                msg = await redis.blpop(*list(mq_list))
-                if not msg:
-                    continue
-                queue_name, data = msg
-                queue_name = queue_name.decode('utf-8')
-                handlers = self.__handlers.get(queue_name, [])
-                for handler in handlers:
-                    self.schedule(queue_name, handler, data)
-
-    async def run_job(self, queue_name, func, *args, **kwargs):
+            queues = [queue_name for queue_name in mq_list if self.can_pull(queue_name)]
+            if not queues:
+                # Everything is busy, leave the messages in the broker.
+                self._capacity.clear()
+                await self._capacity.wait()
+                continue
+            count = {}
+            for queue_name in queues:
+                limit = self.pull_limit(queue_name)
+                count[queue_name] = self.batch_size if limit is None else min(self.batch_size, limit)
+            msg = await self.broker.pop(queues, count, self.pop_timeout(queues), self.batch_linger)
+            if not msg:
+                continue
+            queue_name, batch = msg
+            dequeued_at = self.loop.time()
+            for data in batch:
+                self.dispatch(queue_name, data, dequeued_at)
+
+    async def poll_fair(self):
+        priorities = sorted({self.queue_priorities.get(queue_name, 0) for queue_name in self.__handlers},
+                            reverse=True)
+        levels = [collections.deque(queue_name for queue_name in self.__handlers
+                                    if self.queue_priorities.get(queue_name, 0) == priority)
+                  for priority in priorities]
+        deficits = dict.fromkeys(self.__handlers, 0)
+        drained = set(self.__handlers)
+        while self._is_running:
+            queues = [queue_name for level in levels for queue_name in level if self.can_pull(queue_name)]
+            if not queues:
+                # Everything is busy, leave the messages in the broker.
+                self._capacity.clear()
+                await self._capacity.wait()
+                continue
+            if await self.pop_round(levels, deficits, drained):
+                continue
+            # All empty, block until the next message of any of them.
+            msg = await self.broker.pop(queues, 1, self.pop_timeout(queues))
+            if msg:
+                queue_name, batch = msg
+                self.dispatch(queue_name, batch[0])
+
+    async def pop_round(self, levels, deficits, drained):
+        """
+        One deficit round-robin round over the first priority level with
+        messages, returns how many were popped.
+
+        Every queue of the level that isn't at its own QUEUE_MAX_IN_FLIGHT
+        gets its quantum (BATCH_SIZE * weight) and keeps what it wasn't
+        served, only a queue found empty (in `drained`) starts over. When
+        MAX_IN_FLIGHT leaves less than that, the budget goes to the queues
+        furthest behind their share, see share_budget.
+        """
+        budget = None
+        if self.max_in_flight:
+            # Shared by all queues, pull_limit only accounts for messages already popped.
+            budget = self.max_in_flight + self.prefetch - self.in_flight - self.prefetched
+        for level in levels:
+            # Ties go to whoever comes first, take turns.
+            level.rotate(-1)
+            quanta = {}
+            for queue_name in level:
+                limit = self.queue_pull_limit(queue_name)
+                if limit is None or limit > 0:
+                    quanta[queue_name] = self.batch_size * self.queue_weights.get(queue_name, 1)
+            if not quanta:
+                continue
+            # Only the differences between the deficits matter, keep them small.
+            backlogged = [queue_name for queue_name in quanta if queue_name not in drained]
+            if backlogged:
+                turns = min(deficits[queue_name] / quanta[queue_name] for queue_name in backlogged)
+                if turns > 0:
+                    for queue_name in backlogged:
+                        deficits[queue_name] -= turns * quanta[queue_name]
+            wanted = {}
+            for queue_name, quantum in quanta.items():
+                deficits[queue_name] += quantum
+                count = int(deficits[queue_name])
+                limit = self.pull_limit(queue_name)
+                if limit is not None:
+                    count = min(count, limit)
+                if count > 0:
+                    wanted[queue_name] = count
+            if not wanted:
+                continue
+            counts = wanted
+            if budget is not None and sum(wanted.values()) > budget:
+                counts = self.share_budget(wanted, budget, deficits, quanta)
+            batches = await self.broker.pop_nowait(counts)
+            dequeued_at = self.loop.time()
+            popped = 0
+            for queue_name, count in counts.items():
+                batch = batches.get(queue_name, ())
+                popped += len(batch)
+                if len(batch) < count:
+                    # Drained, don't save up turns.
+                    deficits[queue_name] = 0
+                    drained.add(queue_name)
+                else:
+                    deficits[queue_name] -= len(batch)
+                    drained.discard(queue_name)
+                for data in batch:
+                    self.dispatch(queue_name, data, dequeued_at)
+            if popped:
+                return popped
+        return 0
+
+    @staticmethod
+    def share_budget(wanted, budget, deficits, quanta):
+        """
+        Split `budget` messages between queues wanting more, one at a time
+        to the queue with the largest deficit left in quanta.
+        """
+        counts = dict.fromkeys(wanted, 0)
+        for _ in range(budget):
+            queue_name = max((queue_name for queue_name in wanted if counts[queue_name] < wanted[queue_name]),
+                             key=lambda queue_name: (deficits[queue_name] - counts[queue_name]) / quanta[queue_name])
+            counts[queue_name] += 1
+        return {queue_name: count for queue_name, count in counts.items() if count}
+
+    def has_capacity(self, queue_name):
+        needed = len(self.__handlers.get(queue_name, []))
+        if self.max_in_flight and self.in_flight and self.in_flight + needed > self.max_in_flight:
+            return False
+        queue_max = self.queue_max_in_flight.get(queue_name)
+        running = self.queue_in_flight[queue_name]
+        return not (queue_max and running and running + needed > queue_max)
+
+    def dispatch(self, queue_name, data, dequeued_at=None):
+        """
+        Start the handlers of a message, or buffer it until the in-flight
+        limits allow it.
+        """
+        if dequeued_at is None:
+            dequeued_at = self.loop.time()
+        prefetched = self._prefetched[queue_name]
+        if prefetched or not self.has_capacity(queue_name):
+            prefetched.append((data, dequeued_at))
+            return
+        self.start_message(queue_name, data, dequeued_at)
+
+    def start_message(self, queue_name, data, dequeued_at=None):
+        handlers = self.__handlers.get(queue_name, [])
+        codec = self.queue_codecs.get(queue_name)
+        payload = data if codec is None else Payload(codec, data)
+        coalesce = self.queue_coalesce.get(queue_name)
+        message = None
+        if self.broker.needs_ack or (coalesce is not None and handlers):
+            message = InFlightMessage(queue_name, data, len(handlers))
+        gate = None
+        if coalesce is not None and handlers:
+            key = bytes(data) if coalesce.key is None else coalesce.key(payload)
+            running = self._coalescing.get((queue_name, key))
+            if running is not None:
+                running.copies.append(data)
+                self.count_coalesced(queue_name)
+                return
+            message.coalesce_key = key
+            self._coalescing[(queue_name, key)] = message
+            if coalesce.debounce or coalesce.ttl:
+                # Awaited by every handler before it starts.
+                gate = self.loop.create_task(self.coalesce_gate(message, coalesce))
+        for handler in handlers:
+            self.schedule(queue_name, handler, payload, dequeued_at, message, gate)
+
+    def count_coalesced(self, queue_name):
+        self.jobs_coalesced += 1
+        stats = self.stats.get(queue_name)
+        if stats is not None:
+            stats.jobs_coalesced += 1
+
+    def coalesce_lock_key(self, message):
+        key = message.coalesce_key
+        if not isinstance(key, bytes):
+            key = (key if isinstance(key, str) else repr(key)).encode('utf-8')
+        return '%s:coalesce:%s' % (message.queue_name, hashlib.sha1(key).hexdigest())
+
+    async def coalesce_gate(self, message, coalesce):
+        """
+        Wait out the debounce window, copies popped meanwhile attach to the
+        message, then take the broker lock of its key. False when another
+        worker holds it, the handlers are skipped then.
+        """
+        if coalesce.debounce:
+            await asyncio.sleep(coalesce.debounce, loop=self.loop)
+        if not coalesce.ttl:
+            return True
+        self._locks_taken += 1
+        token = '%s-%d' % (self._lock_prefix, self._locks_taken)
         try:
-            result = await func(*args, **kwargs)
+            locked = await self.broker.lock(self.coalesce_lock_key(message), token, coalesce.ttl)
+        except Exception as e:
+            # Better a duplicate than a lost job.
+            print('coalesce_gate lock error ', str(e))
+            traceback.print_exc(file=sys.stdout)
+            return True
+        if not locked:
+            self.count_coalesced(message.queue_name)
+            return False
+        message.lock_token = token
+        return True
+
+    def encode(self, queue_name, value):
+        """Encode a message the way the handlers of `queue_name` expect it."""
+        return encode_payload(value, self.queue_codecs.get(queue_name), self.compress_threshold)
+
+    def producer(self):
+        """A Producer sharing the settings and the broker (and its pool) of this worker."""
+        return Producer(loop=self.loop, worker_settings=self.worker_settings, broker=self.broker)
+
+    def start_prefetched(self):
+        # One message per queue at a time, so no queue takes all the capacity.
+        started = True
+        while started:
+            started = False
+            for queue_name, prefetched in self._prefetched.items():
+                if prefetched and self.has_capacity(queue_name):
+                    data, dequeued_at = prefetched.popleft()
+                    self.start_message(queue_name, data, dequeued_at)
+                    started = True
+
+    async def requeue_prefetched(self):
+        """
+        Give messages still waiting in the prefetch buffer back to the
+        broker, at the head of their queues in their original order.
+        """
+        for queue_name, prefetched in self._prefetched.items():
+            if prefetched:
+                await self.broker.requeue(queue_name, [data for data, _ in prefetched])
+                prefetched.clear()
+
+    async def run_job(self, queue_name, func, *args, dequeued_at=None, gate=None, **kwargs):
+        if gate is not None and not await gate:
+            raise CoalescedJob()
+        stats = self.stats.get(queue_name)
+        started_at = self.loop.time()
+        if stats is not None and dequeued_at is not None:
+            stats.wait_time.observe(started_at - dequeued_at)
+        try:
+            if getattr(func, '__cpu_bound__', False):
+                result = await self.loop.run_in_executor(
+                    self.get_process_pool(), functools.partial(func, *args, **kwargs))
+            else:
+                result = await func(*args, **kwargs)
         except CancelJob as e:
             # job is cancelled.
             print('The job has been cancelled.')
@@ -104,7 +1198,8 @@ class Worker:
             print('run_job task error ', str(e))
             traceback.print_exc(file=sys.stdout)
             if isinstance(e, HandledExit):
-                return 0
+                # Stopped before it finished, the job isn't done.
+                raise asyncio.CancelledError()
             elif isinstance(e, TerminateWorker):
                 raise e
 
@@ -114,36 +1209,451 @@ class Worker:
             # TODO: log
             print('job has successfully done.')
             return 0
+        finally:
+            if stats is not None:
+                stats.run_time.observe(self.loop.time() - started_at)
 
-    def job_callback(self, task):
+    def job_callback(self, task, queue_name=None, message=None):
         self._pending_tasks.remove(task)
+        self.in_flight -= 1
+        if queue_name is not None:
+            self.queue_in_flight[queue_name] -= 1
+        if self._is_running:
+            self.start_prefetched()
+        self._capacity.set()
         print('_pending_tasks length %d', len(self._pending_tasks))
-        self.jobs_complete += 1
+        if task.cancelled():
+            # Interrupted, neither done nor failed.
+            if message is not None:
+                message.handlers_left -= 1
+                message.interrupted = True
+                if not message.handlers_left:
+                    self.message_done(message)
+            return
         task_exception = task.exception()
+        if isinstance(task_exception, CoalescedJob):
+            # Done by another worker: ack, but it's not a job of this one.
+            if message is not None:
+                message.handlers_left -= 1
+                if not message.handlers_left:
+                    self.message_done(message)
+            return
+        self.jobs_complete += 1
+        stats = self.stats.get(queue_name)
+        if stats is not None:
+            stats.jobs_complete += 1
         if task_exception:
             self._is_running = False
             self._task_exception = task_exception
+            if stats is not None:
+                stats.jobs_failed += 1
         elif task.result():
             self.jobs_failed += 1
+            if stats is not None:
+                stats.jobs_failed += 1
             print('Task complete, %d jobs done, %d failed' % (self.jobs_complete, self.jobs_failed))
+        if message is not None:
+            message.handlers_left -= 1
+            message.failed = message.failed or bool(task_exception or task.result())
+            if not message.handlers_left:
+                self.message_done(message)
+
+    def message_done(self, message):
+        """
+        The last handler of `message` is done, ack it and the copies coalesced
+        into it. An interrupted message that didn't fail goes back to the head
+        of its queue instead, to run again.
+        """
+        if message.coalesce_key is not None:
+            del self._coalescing[(message.queue_name, message.coalesce_key)]
+        if message.lock_token is not None:
+            self.run_broker_call(self.broker.unlock(self.coalesce_lock_key(message), message.lock_token))
+        if not self.broker.needs_ack:
+            return
+        if message.interrupted and not message.failed:
+            self.run_broker_call(self.broker.requeue(message.queue_name, [message.data] + message.copies))
+            return
+        for data in [message.data] + message.copies:
+            self.run_broker_call(self.broker.ack(message.queue_name, data, failed=message.failed))
 
-    def schedule(self, queue_name, handler, data):
-        task = self.loop.create_task(self.run_job(queue_name, handler, data))
-        task.add_done_callback(self.job_callback)
+    def run_broker_call(self, coro):
+        """Run a broker call in the background, shutdown waits for it."""
+        task = self.loop.create_task(coro)
+        self._broker_tasks.add(task)
+        task.add_done_callback(self._broker_tasks.discard)
+
+    def schedule(self, queue_name, handler, data, dequeued_at=None, message=None, gate=None):
+        task = self.loop.create_task(self.run_job(queue_name, handler, data, dequeued_at=dequeued_at, gate=gate))
+        task.add_done_callback(functools.partial(self.job_callback, queue_name=queue_name, message=message))
         self._pending_tasks.add(task)
+        self.in_flight += 1
+        self.queue_in_flight[queue_name] += 1
 
     async def shutdown(self):
         with await self._shutdown_lock:
+            if self.prefetched:
+                print('Shutting down worker, returning %d prefetched messages to the broker' % self.prefetched)
+                await self.requeue_prefetched()
             if self._pending_tasks:
                 print('Shutting down worker, waiting for %d jobs to finish' % len(self._pending_tasks))
                 await asyncio.wait(self._pending_tasks, loop=self.loop)
+            if self._broker_tasks:
+                await asyncio.wait(self._broker_tasks, loop=self.loop)
             await self.close()
 
+    async def sample_stats(self):
+        """
+        Every `stats_interval` seconds, LLEN every queue and work out the
+        jobs/sec since the previous sample.
+        """
+        sampled_at = self.loop.time()
+        while self._is_running:
+            await asyncio.sleep(self.stats_interval, loop=self.loop)
+            now = self.loop.time()
+            for stats in self.stats.values():
+                stats.jobs_per_sec = (stats.jobs_complete - stats._sampled_complete) / (now - sampled_at)
+                stats._sampled_complete = stats.jobs_complete
+            sampled_at = now
+            try:
+                depths = await self.broker.depth(list(self.stats))
+            except Exception as e:
+                print('sample_stats error ', str(e))
+                continue
+            for stats, depth in zip(self.stats.values(), depths):
+                stats.depth = depth
+
+    async def start_stats(self):
+        if self.stats_interval:
+            self._stats_task = self.loop.create_task(self.sample_stats())
+        if self.stats_address is None:
+            return
+        if isinstance(self.stats_address, str):
+            self._stats_server = await asyncio.start_unix_server(
+                self.handle_stats_request, self.stats_address, loop=self.loop)
+        else:
+            host, port = self.stats_address
+            self._stats_server = await asyncio.start_server(
+                self.handle_stats_request, host, port, loop=self.loop)
+
+    async def handle_stats_request(self, reader, writer):
+        """Answer any HTTP request with `stats_text()`."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+            body = self.stats_text().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body))
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def stats_text(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for queue_name, value in samples:
+                lines.append('%s{queue="%s"} %s' % (name, _label(queue_name), value))
+
+        items = sorted(self.stats.items())
+        metric('worker_jobs_complete_total', 'counter', 'Jobs finished, failed or not.',
+               [(queue_name, stats.jobs_complete) for queue_name, stats in items])
+        metric('worker_jobs_failed_total', 'counter', 'Jobs that raised an error.',
+               [(queue_name, stats.jobs_failed) for queue_name, stats in items])
+        metric('worker_jobs_coalesced_total', 'counter', 'Copies of a running job that did not run again.',
+               [(queue_name, stats.jobs_coalesced) for queue_name, stats in items])
+        metric('worker_jobs_in_flight', 'gauge', 'Jobs running.',
+               [(queue_name, self.queue_in_flight[queue_name]) for queue_name, _ in items])
+        metric('worker_jobs_prefetched', 'gauge', 'Messages popped but not started yet.',
+               [(queue_name, len(self._prefetched[queue_name])) for queue_name, _ in items])
+        metric('worker_jobs_per_second', 'gauge', 'Jobs finished per second over the last sample interval.',
+               [(queue_name, '%.3f' % stats.jobs_per_sec) for queue_name, stats in items])
+        metric('worker_queue_depth', 'gauge', 'Messages waiting in the broker.',
+               [(queue_name, stats.depth) for queue_name, stats in items if stats.depth is not None])
+        for name, attr, help in (('worker_job_wait_seconds', 'wait_time', 'Time from dequeue to handler start.'),
+                                 ('worker_job_run_seconds', 'run_time', 'Handler run time.')):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % name)
+            for queue_name, stats in items:
+                histogram = getattr(stats, attr)
+                label = _label(queue_name)
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{queue="%s",le="%s"} %d' % (name, label, bound, cumulative))
+                lines.append('%s_sum{queue="%s"} %r' % (name, label, histogram.sum))
+                lines.append('%s_count{queue="%s"} %d' % (name, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def format_stats(self):
+        """A table of the per queue metrics, printed on SIGUSR1."""
+        lines = ['pid=%d, up %.0fs, %d jobs done, %d failed, %d coalesced, %d in flight' % (
+            os.getpid(), time.time() - self._started_at, self.jobs_complete, self.jobs_failed, self.jobs_coalesced,
+            self.in_flight)]
+        lines.append('%-20s %9s %10s %8s %9s %7s %9s %8s %20s %20s' % (
+            'queue', 'in flight', 'prefetched', 'depth', 'complete', 'failed', 'coalesced', 'jobs/s',
+            'wait p50/p95/p99 ms', 'run p50/p95/p99 ms'))
+        for queue_name, stats in sorted(self.stats.items()):
+            lines.append('%-20s %9d %10d %8s %9d %7d %9d %8.1f %20s %20s' % (
+                queue_name, self.queue_in_flight[queue_name], len(self._prefetched[queue_name]),
+                '-' if stats.depth is None else stats.depth, stats.jobs_complete, stats.jobs_failed,
+                stats.jobs_coalesced, stats.jobs_per_sec,
+                '/'.join('%.1f' % (stats.wait_time.quantile(q) * 1000) for q in (0.5, 0.95, 0.99)),
+                '/'.join('%.1f' % (stats.run_time.quantile(q) * 1000) for q in (0.5, 0.95, 0.99))))
+        return '\n'.join(lines)
+
     async def start(self):
         try:
+            await self.broker.start(list(self.__handlers))
+            await self.start_stats()
             await self.poll()
         finally:
             await self.shutdown()
             if self._task_exception:
                 print('Found task exception "%s"' % self._task_exception)
                 raise self._task_exception
+
+
+class Producer:
+    """
+    Pushes messages for Workers, encoded with the same QUEUE_CODECS and
+    COMPRESS_THRESHOLD settings.
+
+    `enqueue_many` sends ENQUEUE_CHUNK_SIZE messages per RPUSH and up to
+    `pipeline_chunks` of those per round trip. With ENQUEUE_LINGER seconds
+    set, concurrent `enqueue` calls wait that long (or until a chunk is
+    full) and are sent together in one pipeline.
+    """
+    pipeline_chunks = 10
+
+    def __init__(self, *,
+                 loop: asyncio.AbstractEventLoop = None,
+                 worker_settings: dict = None,
+                 broker: Broker = None
+                 ) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.worker_settings = worker_settings or {}
+        self._own_broker = broker is None
+        if broker is None:
+            # ACK: the messages need the header ReliableRedisBroker reads.
+            broker_class = ReliableRedisBroker if self.worker_settings.get('ACK') else RedisBroker
+            broker = broker_class(self.worker_settings, loop=self.loop)
+        self.broker = broker
+        self.queue_codecs = {queue_name: get_codec(codec)
+                             for queue_name, codec in self.worker_settings.get('QUEUE_CODECS', {}).items()}
+        self.compress_threshold = self.worker_settings.get('COMPRESS_THRESHOLD', 1024)
+        self.chunk_size = self.worker_settings.get('ENQUEUE_CHUNK_SIZE', 1000)
+        self.linger = self.worker_settings.get('ENQUEUE_LINGER', 0)
+        self._batch = None  # queue name -> messages waiting for the next flush
+        self._batch_size = 0
+        self._batch_done = None
+        self._batch_timer = None
+
+    def encode(self, queue_name, value):
+        """Encode a message the way the handlers of `queue_name` expect it."""
+        return encode_payload(value, self.queue_codecs.get(queue_name), self.compress_threshold)
+
+    async def enqueue(self, queue_name, value):
+        message = self.encode(queue_name, value)
+        if not self.linger:
+            await self.broker.push(queue_name, message)
+            return
+        if self._batch is None:
+            self._batch = {}
+            self._batch_size = 0
+            self._batch_done = self.loop.create_future()
+            self._batch_timer = self.loop.call_later(self.linger, self._start_flush)
+        self._batch.setdefault(queue_name, []).append(message)
+        self._batch_size += 1
+        done = self._batch_done
+        if self._batch_size >= self.chunk_size:
+            self._start_flush()
+        # Don't cancel the flush for everyone else when this caller is cancelled.
+        await asyncio.shield(done, loop=self.loop)
+
+    async def enqueue_many(self, queue_name, values):
+        """
+        Encode and push all of `values`, an iterable consumed a chunk at a
+        time. Returns the number of messages pushed.
+        """
+        items = []
+        chunk = []
+        count = 0
+        for value in values:
+            chunk.append(self.encode(queue_name, value))
+            if len(chunk) >= self.chunk_size:
+                items.append((queue_name, chunk))
+                count += len(chunk)
+                chunk = []
+                if len(items) >= self.pipeline_chunks:
+                    await self.broker.push_many(items)
+                    items = []
+        if chunk:
+            items.append((queue_name, chunk))
+            count += len(chunk)
+        if items:
+            await self.broker.push_many(items)
+        return count
+
+    def _start_flush(self):
+        if self._batch is None:
+            return
+        batch, done = self._batch, self._batch_done
+        self._batch_timer.cancel()
+        self._batch = self._batch_done = self._batch_timer = None
+        return self.loop.create_task(self._flush(batch, done))
+
+    async def _flush(self, batch, done):
+        items = [(queue_name, messages[start:start + self.chunk_size])
+                 for queue_name, messages in batch.items()
+                 for start in range(0, len(messages), self.chunk_size)]
+        try:
+            await self.broker.push_many(items)
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
+
+    async def flush(self):
+        """Send the messages waiting for ENQUEUE_LINGER now."""
+        task = self._start_flush()
+        if task is not None:
+            await task
+
+    async def close(self):
+        await self.flush()
+        if self._own_broker:
+            await self.broker.close()
+
+
+def run_worker(worker_factory, stats_fd=None):
+    """
+    Run the Worker returned by `worker_factory(loop)` on a new event loop
+    until it's stopped and return the exit status. The jobs_complete and
+    jobs_failed counters are written to `stats_fd` when given.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = None
+    status = 0
+    try:
+        worker = worker_factory(loop)
+        try:
+            loop.run_until_complete(worker.start())
+        except HandledExit:
+            loop.run_until_complete(worker.shutdown())
+    except ImmediateExit as e:
+        print(e)
+        status = 1
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        status = 1
+    finally:
+        if worker is not None and stats_fd is not None:
+            os.write(stats_fd, ('%d %d' % (worker.jobs_complete, worker.jobs_failed)).encode())
+    return status
+
+
+class Supervisor:
+    """
+    Prefork `processes` workers (one per core by default), each running the
+    Worker returned by `worker_factory(loop)` on its own event loop.
+
+    Crashed workers are restarted after `restart_delay` seconds. SIGTERM and
+    SIGINT are passed on to every worker, the first one drains them
+    gracefully and a second one forces them to exit, as with a single
+    Worker. The workers get their own process group, so Ctrl-C only reaches
+    them through the supervisor.
+    """
+    def __init__(self, worker_factory, *, processes: int = None, restart_delay: float = 1) -> None:
+        self.worker_factory = worker_factory
+        self.processes = processes or os.cpu_count() or 1
+        self.restart_delay = restart_delay
+        self._children = {}  # pid -> read end of the child's stats pipe
+        self._is_running = True
+        self.jobs_complete = 0
+        self.jobs_failed = 0
+        self.restarts = 0
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.close(read_fd)
+                for fd in self._children.values():
+                    os.close(fd)
+                status = run_worker(self.worker_factory, write_fd)
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        os.close(write_fd)
+        self._children[pid] = read_fd
+        print('pid=%d, started worker %d' % (os.getpid(), pid))
+        return pid
+
+    def reap(self, pid, status):
+        """
+        Collect the counters of an exited worker and return its exit code,
+        negative when it was killed by a signal.
+        """
+        read_fd = self._children.pop(pid)
+        # The worker's process pool may still hold the write end, don't wait for EOF.
+        os.set_blocking(read_fd, False)
+        try:
+            counters = os.read(read_fd, 64).split()
+        except BlockingIOError:
+            counters = None
+        finally:
+            os.close(read_fd)
+        if counters:
+            self.jobs_complete += int(counters[0])
+            self.jobs_failed += int(counters[1])
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def handle_sig(self, signum, frame):
+        self._is_running = False
+        print('pid=%d, got signal: %d, stopping %d workers...' % (os.getpid(), signum, len(self._children)))
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.handle_sig)
+        signal.signal(signal.SIGTERM, self.handle_sig)
+        for _ in range(self.processes):
+            self.spawn()
+        while self._children:
+            pid, status = os.wait()
+            if pid not in self._children:
+                continue
+            code = self.reap(pid, status)
+            try:
+                # Don't leave the process pool of a crashed worker behind.
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            if code and self._is_running:
+                print('pid=%d, worker %d exited with %d, restarting' % (os.getpid(), pid, code))
+                time.sleep(self.restart_delay)
+                if self._is_running:
+                    self.restarts += 1
+                    self.spawn()
+        print('All workers stopped, %d jobs done, %d failed, %d restarts' % (
+            self.jobs_complete, self.jobs_failed, self.restarts))
@@ -0,0 +1,455 @@
+# coding=utf-8
+"""Benchmarks for coloredorjsonlogs.
+
+Usage:
+    python bench_coloredorjsonlogs.py json-encoder [-n RECORDS]
+    python bench_coloredorjsonlogs.py emit [-n RECORDS] [--output FILE]
+                                           [--baseline FILE] [--max-regression RATIO]
+    python bench_coloredorjsonlogs.py check
+
+`emit` logs through a dedicated logger (the patched Logger._log, emit and
+_emit) for every combination of output mode, fields, message size, thread
+count and sink, plus records filtered out by level. It reports records/sec
+and per-call latency percentiles, can write them to a JSON file and compare
+them against a previous run, exiting with status 1 when a scenario lost more
+than --max-regression of its throughput or p99 latency.
+
+`check` makes sure the `install(...)` calls of the README install what they
+say (background writer, rate limit filter, log file, forwarding handler),
+that the background writer reports its drops, that a rate limit storm
+reports its count once it's over, and that log file rotation keeps the
+newest `backup_count` archives. It exits with status 1 when one of them
+fails.
+"""
+import argparse
+import collections
+import datetime
+import glob
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import coloredorjsonlogs
+
+
+def make_record(fields=None, message='user %s paid %d'):
+    record = logging.LogRecord('bench', logging.INFO, __file__, 1, message, ('alice', 42), None)
+    record.fields = {} if fields is None else fields
+    return record
+
+
+def legacy_json_line(record):
+    """The JSON line as `ColoredStreamHandler` used to build it."""
+    foo = {"message": record.getMessage(), "level": record.levelname, "timestamp": datetime.datetime.now().isoformat()}
+    if hasattr(record, 'fields') and isinstance(record.fields, dict):
+        foo['fields'] = record.fields
+    return json.dumps(foo, default=str)
+
+
+def encoder_json_line(record, encoder=coloredorjsonlogs.JsonRecordEncoder()):
+    return encoder.encode(record, record.getMessage())
+
+
+def records_per_sec(func, record, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(record)
+    return n / (time.perf_counter() - start)
+
+
+def bench_json_encoder(n):
+    payloads = [
+        ('no fields', {}),
+        ('scalar fields', dict(name='Mr. White', card_number=12345678, balance=12.5, vip=True, note=None)),
+        ('mixed fields', dict(name='Mr. White', tags=['a', 'b'], at=datetime.date(2017, 3, 30))),
+    ]
+    print('%-14s %16s %16s %8s' % ('payload', 'legacy rec/s', 'encoder rec/s', 'speedup'))
+    for name, fields in payloads:
+        record = make_record(fields)
+        assert json.loads(legacy_json_line(record))['fields'] == json.loads(encoder_json_line(record))['fields']
+        legacy = records_per_sec(legacy_json_line, record, n)
+        encoder = records_per_sec(encoder_json_line, record, n)
+        print('%-14s %16.0f %16.0f %7.2fx' % (name, legacy, encoder, encoder / legacy))
+
+
+class NullStream(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_handler(mode, sink, tmpdir):
+    no_color = mode == 'json'
+    if sink == 'null':
+        return coloredorjsonlogs.ColoredStreamHandler(stream=NullStream(), isatty=True, no_color=no_color)
+    return coloredorjsonlogs.ColoredFileHandler(os.path.join(tmpdir, '%s.log' % mode), no_color=no_color)
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def run_scenario(logger, level, message, fields, threads, n):
+    """
+    Log ``n`` records from each of ``threads`` threads, returning the
+    records/sec over all threads and the sorted per-call latencies.
+    """
+    latencies = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        timer = time.perf_counter
+        log = logger.log
+        own = []
+        barrier.wait()
+        for i in range(n):
+            start = timer()
+            log(level, message, i, **fields)
+            own.append(timer() - start)
+        latencies.extend(own)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return threads * n / elapsed, latencies
+
+
+def summarize(records_per_sec, latencies):
+    return {
+        'records_per_sec': round(records_per_sec, 1),
+        'p50_us': round(percentile(latencies, 0.50) * 1e6, 3),
+        'p90_us': round(percentile(latencies, 0.90) * 1e6, 3),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 3),
+        'p999_us': round(percentile(latencies, 0.999) * 1e6, 3),
+        'max_us': round(latencies[-1] * 1e6, 3),
+    }
+
+
+def bench_emit(n, modes, with_fields, payloads, thread_counts, sinks):
+    fields_by_name = {
+        'nofields': {},
+        'fields': dict(name='Mr. White', card_number=12345678, balance=12.5, vip=True),
+    }
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='bench_coloredorjsonlogs')
+    try:
+        print('%-32s %12s %9s %9s %9s %9s' % ('scenario', 'records/s', 'p50 us', 'p90 us', 'p99 us', 'p999 us'))
+        scenarios = [(mode, fields_name, payload, threads, sink) for mode, fields_name, payload, threads, sink
+                     in itertools.product(modes, with_fields, payloads, thread_counts, sinks)]
+        scenarios += [('filtered', 'nofields', payloads[0], threads, 'null') for threads in thread_counts]
+        for mode, fields_name, payload, threads, sink in scenarios:
+            name = '/'.join((mode, fields_name, '%dB' % payload, '%dt' % threads, sink))
+            logger = logging.getLogger('bench.%s' % name)
+            logger.propagate = False
+            handler = make_handler('json' if mode == 'filtered' else mode, sink, tmpdir)
+            logger.addHandler(handler)
+            if mode == 'filtered':
+                logger.setLevel(logging.INFO)
+                level = logging.DEBUG
+            else:
+                level = logging.INFO
+            message = 'x' * max(payload - 3, 0) + ' %d'
+            try:
+                results[name] = summary = summarize(*run_scenario(
+                    logger, level, message, fields_by_name[fields_name], threads, n))
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+            print('%-32s %12.0f %9.2f %9.2f %9.2f %9.2f' % (
+                name, summary['records_per_sec'], summary['p50_us'], summary['p90_us'],
+                summary['p99_us'], summary['p999_us']))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def find_regressions(results, baseline, max_regression):
+    """
+    Return a message for every scenario whose throughput dropped or whose p99
+    latency grew by more than ``max_regression`` (a ratio) against the
+    baseline results.
+    """
+    regressions = []
+    for name, summary in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        if summary['records_per_sec'] < before['records_per_sec'] * (1 - max_regression):
+            regressions.append('%s: %.0f records/s, baseline %.0f' % (
+                name, summary['records_per_sec'], before['records_per_sec']))
+        if summary['p99_us'] > before['p99_us'] * (1 + max_regression):
+            regressions.append('%s: p99 %.2f us, baseline %.2f us' % (name, summary['p99_us'], before['p99_us']))
+    return regressions
+
+
+def check_install(tmpdir):
+    failures = []
+    root_logger = logging.getLogger()
+
+    def expect(call, condition):
+        handlers = [h for h in root_logger.handlers if isinstance(h, coloredorjsonlogs.ColoredStreamHandler)]
+        if handlers != [coloredorjsonlogs.root_handler]:
+            failures.append('%s: root handlers %r' % (call, handlers))
+        elif not condition(coloredorjsonlogs.root_handler):
+            failures.append('%s: installed %r' % (call, coloredorjsonlogs.root_handler))
+
+    coloredorjsonlogs.install(level=logging.INFO, no_color=1, background=dict(
+        queue_size=10000, full_policy='drop_newest', flush_interval=1.0, flush_size=64 * 1024))
+    expect('background', lambda h: isinstance(h.writer, coloredorjsonlogs.BackgroundWriter)
+           and h.writer.full_policy == 'drop_newest')
+    coloredorjsonlogs.install(caller_info='cached')
+    expect('caller_info', lambda h: h.writer is not None)
+    coloredorjsonlogs.install(rate_limit=dict(rate=1.0, burst=10, key='callsite'))
+    expect('rate_limit', lambda h: any(isinstance(f, coloredorjsonlogs.RateLimitFilter) for f in h.filters))
+    filename = os.path.join(tmpdir, 'worker.log')
+    coloredorjsonlogs.install(level=logging.INFO, no_color=1, filename=filename, max_bytes=512 * 1024 * 1024,
+                              interval=86400, backup_count=14, compress=True, background=True)
+    expect('filename', lambda h: isinstance(h, coloredorjsonlogs.ColoredFileHandler) and h.writer is not None)
+    logging.getLogger('bench.check').info('to the file')
+    coloredorjsonlogs.install(level=logging.INFO, aggregate=os.path.join(tmpdir, 'worker-logs.sock'))
+    expect('aggregate', lambda h: isinstance(h, coloredorjsonlogs.ForwardingHandler))
+    coloredorjsonlogs.set_caller_info('full')
+    coloredorjsonlogs.install()
+    expect('defaults', lambda h: type(h) is coloredorjsonlogs.ColoredStreamHandler and h.writer is None)
+    # Replacing the file handler closed it.
+    with open(filename) as f:
+        if 'to the file' not in f.read():
+            failures.append('filename: the record is not in the file')
+    return failures
+
+
+def check_background_writer():
+    failures = []
+    stream = io.StringIO()
+    handler = coloredorjsonlogs.ColoredStreamHandler(stream=stream, isatty=False, no_color=True)
+    writer = handler.start_background_writer(queue_size=10, full_policy='drop_newest', flush_interval=60)
+    for _ in range(1000):
+        handler.handle(make_record())
+    handler.close()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    dropped = sum(line['fields'].get('dropped', 0) for line in lines)
+    if not writer.dropped or dropped != writer.dropped:
+        failures.append('%d records dropped, the notices report %d' % (writer.dropped, dropped))
+    failures += check_fork()
+    notice_handler = handler._drop_notice_handler
+    if notice_handler is None or notice_handler.json_encoder is handler.json_encoder \
+            or notice_handler._render_plans is handler._render_plans:
+        failures.append('drop notices share the caches of the emitting threads')
+    return failures
+
+
+def check_fork():
+    """A forked child logs through a writer thread of its own."""
+    if not hasattr(os, 'fork'):
+        return []
+    failures = []
+    fd, path = tempfile.mkstemp(prefix='bench_coloredorjsonlogs')
+    os.close(fd)
+    with open(path, 'a') as stream:
+        handler = coloredorjsonlogs.ColoredStreamHandler(stream=stream, isatty=False, no_color=True)
+        handler.start_background_writer(queue_size=10, full_policy='block')
+        for _ in range(100):
+            handler.handle(make_record(message='parent %s %d'))
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                for _ in range(1000):
+                    handler.handle(make_record(message='child %s %d'))
+                handler.close()
+                status = 0
+            finally:
+                os._exit(status)
+        deadline = time.time() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done or time.time() >= deadline:
+                break
+            time.sleep(0.01)
+        if not done:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            failures.append('a forked child hangs on a full background writer queue')
+        handler.close()
+    with open(path) as f:
+        messages = collections.Counter(json.loads(line)['message'].split()[0] for line in f)
+    os.remove(path)
+    if messages != {'parent': 100, 'child': 1000} and done:
+        failures.append('lines written around a fork: %r' % dict(messages))
+    return failures
+
+
+def check_rate_limit():
+    failures = []
+    stream = io.StringIO()
+    handler = coloredorjsonlogs.ColoredStreamHandler(stream=stream, isatty=False, no_color=True)
+    handler.addFilter(coloredorjsonlogs.RateLimitFilter(rate=1.0 / 60, burst=1))
+    for _ in range(1000):
+        handler.handle(make_record(message='redis down for %s (%d)'))
+    handler.close()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    if [line['fields'].get('repeated') for line in lines] != [None, 999]:
+        failures.append('storm of 1000: %r' % lines)
+
+    # A window closing is noticed on the next record of any key.
+    stream = io.StringIO()
+    handler = coloredorjsonlogs.ColoredStreamHandler(stream=stream, isatty=False, no_color=True)
+    handler.addFilter(coloredorjsonlogs.RateLimitFilter(rate=10, burst=1, key='template'))
+    now = time.time()
+    for i in range(10):
+        record = make_record(message='storm for %s (%d)')
+        record.created = now + i * 0.001
+        handler.handle(record)
+    record = make_record(message='other for %s (%d)')
+    record.created = now + 1
+    handler.handle(record)
+    lines = [(line['message'], line['fields'].get('repeated')) for line in map(json.loads, stream.getvalue().splitlines())]
+    if lines != [('storm for alice (42)', None), ('storm for alice (42)', 9), ('other for alice (42)', None)]:
+        failures.append('window close: %r' % lines)
+
+    # Call sites are told apart whatever the caller lookup.
+    for mode in ('full', 'cached'):
+        coloredorjsonlogs.set_caller_info(mode)
+        stream = io.StringIO()
+        handler = coloredorjsonlogs.ColoredStreamHandler(stream=stream, isatty=False, no_color=True)
+        handler.addFilter(coloredorjsonlogs.RateLimitFilter(rate=1.0 / 60, burst=1))
+        logger = logging.getLogger('bench.check.callsite')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for _ in range(3):
+                logger.error('first call site')
+                logger.error('second call site')
+        finally:
+            logger.removeHandler(handler)
+        lines = [(line['message'], line['fields'].get('repeated')) for line in map(json.loads, stream.getvalue().splitlines())]
+        if lines != [('first call site', None), ('second call site', None)]:
+            failures.append('two call sites with caller_info=%r: %r' % (mode, lines))
+        handler.close()
+    coloredorjsonlogs.set_caller_info('full')
+
+    record = make_record()
+    record.pathname, record.lineno = '(unknown file)', 0
+    if coloredorjsonlogs.RateLimitFilter.callsite_key(record) == ('(unknown file)', 0):
+        failures.append('callsite key without caller info')
+    return failures
+
+
+def check_rotation(tmpdir):
+    failures = []
+    filename = os.path.join(tmpdir, 'rotated.log')
+    handler = coloredorjsonlogs.ColoredFileHandler(filename, max_bytes=2000, backup_count=3, no_color=True)
+    for i in range(2000):
+        handler.handle(make_record(message='line %d, %%s %%d' % i))
+    stream = handler.stream
+    handler.close()
+    archives = stream.archives()
+    last = '%s.%s' % (filename, stream._last_segment[0])
+    if stream._last_segment[1]:
+        last += '.%d' % stream._last_segment[1]
+    if len(archives) != 3 or archives[-1] != last + '.gz':
+        failures.append('archives %r, last rotation %s' % (archives, last))
+    leftovers = [path for path in glob.glob(filename + '.*') if not path.endswith('.gz')]
+    if leftovers:
+        failures.append('segments left uncompressed: %r' % leftovers)
+
+    # A failed rename must still leave an open file behind.
+    filename = os.path.join(tmpdir, 'unrenamable.log')
+    stream = coloredorjsonlogs.RotatingFileStream(filename, max_bytes=100, compress=False)
+    stream.write('x' * 80 + '\n')
+    stream.flush()
+    os.remove(filename)
+    try:
+        stream.write('y' * 80 + '\n')
+        failures.append('rotation of a removed file did not fail')
+    except OSError:
+        pass
+    try:
+        stream.write('z\n')
+        stream.close()
+    except ValueError as e:
+        failures.append('write after a failed rotation: %s' % e)
+    else:
+        with open(filename) as f:
+            if f.read() != 'z\n':
+                failures.append('write after a failed rotation was lost')
+    return failures
+
+
+def check():
+    tmpdir = tempfile.mkdtemp(prefix='bench_coloredorjsonlogs')
+    try:
+        failures = check_install(tmpdir) + check_background_writer() + check_rate_limit() + check_rotation(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for failure in failures:
+        print('FAILED %s' % failure)
+    print('%d failures' % len(failures))
+    return 1 if failures else 0
+
+
+def comma_list(convert=str):
+    return lambda value: [convert(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['json-encoder', 'emit', 'check'])
+    parser.add_argument('-n', '--records', type=int, default=None,
+                        help='records per scenario (and thread for emit)')
+    parser.add_argument('--modes', type=comma_list(), default=['colored', 'json'])
+    parser.add_argument('--fields', type=comma_list(), default=['nofields', 'fields'])
+    parser.add_argument('--payloads', type=comma_list(int), default=[32, 256, 4096], help='message sizes in bytes')
+    parser.add_argument('--threads', type=comma_list(int), default=[1, 4])
+    parser.add_argument('--sinks', type=comma_list(), default=['null', 'file'])
+    parser.add_argument('--caller-info', choices=['full', 'cached', 'off'], default='full')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--max-regression', type=float, default=0.10,
+                        help='allowed throughput/p99 regression against the baseline (default 0.10)')
+    args = parser.parse_args(argv)
+    if args.benchmark == 'check':
+        return check()
+    if args.benchmark == 'json-encoder':
+        bench_json_encoder(args.records or 200000)
+        return 0
+
+    coloredorjsonlogs.set_caller_info(args.caller_info)
+    results = bench_emit(args.records or 20000, args.modes, args.fields, args.payloads, args.threads, args.sinks)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'caller_info': args.caller_info,
+                'records': args.records or 20000,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, args.max_regression)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,25 @@
 # coding=utf-8
 # from coloredlogs
+import atexit
+import collections
 import datetime
+import glob
+import gzip
+import io
 import logging
 import copy
+import os
+import re
+import shutil
+import signal
+import socket
 import sys
+import threading
 import time
+import traceback
+import weakref
 import json
+from json.encoder import encode_basestring_ascii
 
 BLACK = 10001
 RED = 10002
@@ -17,15 +31,85 @@ CYAN = 10007
 WHITE = 10008
 HTTP_RESP = 20000
 
+# How the patched Logger._log finds the file, line and function of a log call:
+# 'full' walks the stack with Logger.findCaller() for every record, 'cached'
+# remembers the location of each call site and 'off' skips the lookup.
+caller_info = 'full'
+caller_cache_size = 4096
+_unknown_caller = ("(unknown file)", 0, "(unknown function)")
+_caller_cache = {}
+_internal_code_cache = {}
+_caller_cache_lock = threading.Lock()
 
 
-if sys.version >= (3, 0, 0):
+def set_caller_info(mode):
+    """
+    Choose how log calls look up their caller, one of ``full`` (the default),
+    ``cached`` or ``off``. Applies to every logger in the process.
+    """
+    global caller_info
+    if mode not in ('full', 'cached', 'off'):
+        raise ValueError("Invalid caller_info %r! (expected one of cached, full, off)" % (mode,))
+    caller_info = mode
+
+
+def _is_internal_code(code):
+    filename = os.path.normcase(code.co_filename)
+    return filename == logging._srcfile or filename == _this_srcfile
+
+
+def _find_caller_cached():
+    """
+    Return ``(filename, lineno, funcName)`` of the first frame outside the
+    :py:mod:`logging` module and this module. Both whether a code object is
+    internal and the location of a call site (the code object and
+    instruction offset of the calling frame) are cached, so a repeated log
+    statement costs a few dictionary lookups instead of a stack walk. Cache
+    reads take no lock, inserts are serialized and the caches are cleared
+    once they hold ``caller_cache_size`` entries. Code objects are kept
+    alive by their cache entries, which keeps their ``id()`` unique.
+    """
+    f = sys._getframe(1)
+    while f is not None:
+        code = f.f_code
+        entry = _internal_code_cache.get(id(code))
+        if entry is None or entry[0] is not code:
+            entry = (code, _is_internal_code(code))
+            with _caller_cache_lock:
+                if len(_internal_code_cache) >= caller_cache_size:
+                    _internal_code_cache.clear()
+                _internal_code_cache[id(code)] = entry
+        if not entry[1]:
+            break
+        f = f.f_back
+    else:
+        return _unknown_caller
+    key = (id(code), f.f_lasti)
+    entry = _caller_cache.get(key)
+    if entry is None or entry[0] is not code:
+        entry = (code, (code.co_filename, f.f_lineno, code.co_name))
+        with _caller_cache_lock:
+            if len(_caller_cache) >= caller_cache_size:
+                _caller_cache.clear()
+            _caller_cache[key] = entry
+    return entry[1]
+
+
+if sys.version_info >= (3, 0, 0):
+    # Since 3.11 findCaller() stops at the first frame outside logging, which
+    # is _log_patch itself, ask it for the next one.
+    _find_caller_args = (2,) if sys.version_info >= (3, 11) else ()
+
     def _log_patch(self, level, msg, args, exc_info=None, extra=None, stack_info=False, **kwargs):
         from logging import _srcfile
         sinfo = None
-        if _srcfile:
+        if caller_info == 'cached' and not stack_info:
+            fn, lno, func = _find_caller_cached()
+        elif caller_info == 'off' and not stack_info:
+            fn, lno, func = _unknown_caller
+        elif _srcfile:
             try:
-                fn, lno, func, sinfo = self.findCaller(stack_info)
+                fn, lno, func, sinfo = self.findCaller(stack_info, *_find_caller_args)
             except ValueError:  # pragma: no cover
                 fn, lno, func = "(unknown file)", 0, "(unknown function)"
         else:  # pragma: no cover
@@ -43,7 +127,11 @@ if sys.version >= (3, 0, 0):
 else:
     def _log_patch(self, level, msg, args, exc_info=None, extra=None, **kwargs):
         from logging import _srcfile
-        if _srcfile:
+        if caller_info == 'cached':
+            fn, lno, func = _find_caller_cached()
+        elif caller_info == 'off':
+            fn, lno, func = _unknown_caller
+        elif _srcfile:
             #IronPython doesn't track Python frames, so findCaller raises an
             #exception on some versions of IronPython. We trap it here so that
             #IronPython can use logging.
@@ -63,6 +151,7 @@ else:
 
 
 logging.Logger._log = _log_patch
+_this_srcfile = os.path.normcase(_log_patch.__code__.co_filename)
 
 
 def get_logger(logger_name):
@@ -76,10 +165,118 @@ def get_logger(logger_name):
     logger.log_cyan = lambda x: logger.log(CYAN, x)
     logger.log_white = lambda x: logger.log(WHITE, x)
     logger.log_http = lambda x: logger.log(HTTP_RESP, x)
+    logger.bind = lambda **fields: BoundLogger(logger, fields)
 
     return logger
 
 
+class BoundLogger(object):
+    """
+    A lightweight child of a :py:class:`logging.Logger` carrying context
+    fields that are added to every record it logs, with the fields passed to
+    a call merged on top::
+        job_logger = logger.bind(request_id=request_id, queue='sync_wallet')
+        job_logger.info("balance: %d", 123, card_number=12345678)
+    The JSON encoding of the context fields is computed once, on the first
+    JSON record, and spliced into every following record. Creating one only
+    stores the logger and the fields.
+    """
+
+    __slots__ = ('logger', 'fields', '_encoded_fields')
+
+    def __init__(self, logger, fields):
+        self.logger = logger
+        self.fields = fields
+        self._encoded_fields = None
+
+    def bind(self, **fields):
+        """
+        Return a :py:class:`BoundLogger` with these fields added.
+        """
+        merged = self.fields.copy()
+        merged.update(fields)
+        return BoundLogger(self.logger, merged)
+
+    def encoded_fields(self, encoder):
+        """
+        The context fields encoded by :py:meth:`JsonRecordEncoder.encode_fields()`.
+        """
+        if self._encoded_fields is None:
+            self._encoded_fields = encoder.encode_fields(self.fields)
+        return self._encoded_fields
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, args, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs.setdefault('exc_info', True)
+        self.error(msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self._log(logging.CRITICAL, msg, args, **kwargs)
+
+    fatal = critical
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            self._log(level, msg, args, **kwargs)
+
+    def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, **kwargs):
+        # The log call is found by skipping the frames of this module, which
+        # findCaller() would report.
+        logger = self.logger
+        if caller_info == 'off' and not stack_info:
+            fn, lno, func = _unknown_caller
+        else:
+            fn, lno, func = _find_caller_cached()
+        sinfo = None
+        if stack_info:
+            sinfo = 'Stack (most recent call last):\n' + ''.join(traceback.format_stack(sys._getframe(2))).rstrip('\n')
+        if exc_info:
+            if isinstance(exc_info, BaseException):
+                exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+            elif not isinstance(exc_info, tuple):
+                exc_info = sys.exc_info()
+        record = logger.makeRecord(logger.name, level, fn, lno, msg, args, exc_info, func, extra, sinfo)
+        record.fields = kwargs
+        record.bound_logger = self
+        logger.handle(record)
+
+
+def record_fields(record):
+    """
+    The fields of a record: the context fields of the :py:class:`BoundLogger`
+    it was logged with updated by the fields passed to the log call.
+    """
+    fields = getattr(record, 'fields', None)
+    bound_logger = getattr(record, 'bound_logger', None)
+    if bound_logger is None or not bound_logger.fields:
+        return fields
+    merged = bound_logger.fields.copy()
+    if isinstance(fields, dict):
+        merged.update(fields)
+    return merged
+
+
 root_handler = None
 # Portable color codes from http://en.wikipedia.org/wiki/ANSI_escape_code#Colors.
 ansi_color_codes = dict(black=0, red=1, green=2, yellow=3, blue=4, magenta=5, cyan=6, white=7)
@@ -125,6 +322,517 @@ def ansi_text(text, color=None, bold=False, faint=False, underline=False, invers
         return text
 
 
+_background_writers = weakref.WeakSet()
+
+
+def _flush_background_writers():
+    # Or the child inherits the lines buffered in the streams and writes them again.
+    for writer in list(_background_writers):
+        writer.flush(timeout=1.0)
+
+
+def _restart_background_writers():
+    for writer in list(_background_writers):
+        writer._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_flush_background_writers, after_in_child=_restart_background_writers)
+
+
+class BackgroundWriter(object):
+    """
+    Move stream writes off the logging call path. Formatted lines are put on
+    a bounded queue and a dedicated daemon thread drains it, joining every
+    line it finds into a single ``write()`` and flushing the stream once
+    ``flush_size`` characters are pending or ``flush_interval`` seconds have
+    passed since the first unflushed write.
+    :param stream: The stream to write to (anything with ``write`` and ``flush``).
+    :param queue_size: The maximum number of queued lines.
+    :param full_policy: What :py:meth:`put` does when the queue is full:
+                        ``block`` waits for the writer thread, ``drop_oldest``
+                        discards the oldest queued line and ``drop_newest``
+                        discards the new one.
+    :param flush_interval: The maximum number of seconds a written line stays
+                           unflushed.
+    :param flush_size: The number of unflushed characters that forces a flush.
+    :param dropped_line: Called with the number of lines dropped since the last
+                         drain, returns a line (including its terminator) that
+                         is written in their place.
+
+    Writers are flushed before a fork, and a forked child gets a writer
+    thread of its own with an empty queue, lines queued in the meantime are
+    the parent's to write.
+    """
+
+    policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, stream, queue_size=10000, full_policy='block',
+                 flush_interval=1.0, flush_size=64 * 1024, dropped_line=None):
+        if full_policy not in self.policies:
+            raise ValueError("Invalid full_policy %r! (expected one of %s)" % (full_policy, ', '.join(self.policies)))
+        self.stream = stream
+        self.queue_size = queue_size
+        self.full_policy = full_policy
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.dropped_line = dropped_line
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._dropped = 0
+        self._enqueued = 0
+        self._flushed = 0
+        self._force_flush = False
+        self._closing = False
+        self._start()
+        _background_writers.add(self)
+        atexit.register(self.close)
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        if not self._closing:
+            self._thread = threading.Thread(target=self._run, name='BackgroundWriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _after_fork(self):
+        """
+        In a forked child: the writer thread is gone and the lock may have
+        been held by it, start over with a new thread, lock and queue.
+        """
+        self._queue = collections.deque()
+        self._dropped = 0
+        self._enqueued = self._flushed = 0
+        self._force_flush = False
+        after_fork = getattr(self.stream, 'after_fork', None)
+        if after_fork is not None:
+            after_fork()
+        self._start()
+
+    def put(self, line):
+        """
+        Queue a line for the writer thread. Once the writer is closed lines are
+        written synchronously, so records logged during shutdown still appear.
+        """
+        with self._lock:
+            if not self._closing:
+                if len(self._queue) >= self.queue_size:
+                    if self.full_policy == 'drop_newest':
+                        self._dropped += 1
+                        self.dropped += 1
+                        return
+                    elif self.full_policy == 'drop_oldest':
+                        self._queue.popleft()
+                        self._dropped += 1
+                        self.dropped += 1
+                    else:
+                        while len(self._queue) >= self.queue_size and not self._closing:
+                            self._not_full.wait()
+                if not self._closing:
+                    self._queue.append(line)
+                    self._enqueued += 1
+                    if len(self._queue) == 1:
+                        self._not_empty.notify()
+                    return
+        self.stream.write(line)
+        self.stream.flush()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every line queued so far has been written and flushed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            target = self._enqueued
+            self._force_flush = True
+            self._not_empty.notify()
+            while self._flushed < target and self._thread.is_alive():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._drained.wait(remaining)
+
+    def close(self, timeout=None):
+        """
+        Stop the writer thread after it has written and flushed every queued
+        line. Registered with :py:mod:`atexit`, safe to call more than once.
+        """
+        with self._lock:
+            self._closing = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run(self):
+        unflushed = 0
+        flush_at = None
+        while True:
+            with self._lock:
+                if not self._queue and not self._closing and not self._force_flush:
+                    self._not_empty.wait(None if flush_at is None else max(flush_at - time.time(), 0))
+                batch, self._queue = self._queue, collections.deque()
+                dropped, self._dropped = self._dropped, 0
+                enqueued = self._enqueued
+                force_flush, self._force_flush = self._force_flush, False
+                closing = self._closing
+                if batch:
+                    self._not_full.notify_all()
+            if dropped and self.dropped_line is not None:
+                batch.append(self.dropped_line(dropped))
+            try:
+                if batch:
+                    data = ''.join(batch)
+                    self.stream.write(data)
+                    unflushed += len(data)
+                    if flush_at is None:
+                        flush_at = time.time() + self.flush_interval
+                if unflushed and (force_flush or closing or unflushed >= self.flush_size
+                                  or time.time() >= flush_at):
+                    self.stream.flush()
+                    unflushed = 0
+                    flush_at = None
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc(file=sys.__stderr__)
+            with self._lock:
+                if not unflushed:
+                    self._flushed = enqueued
+                    self._drained.notify_all()
+            if closing:
+                return
+
+
+class RotatingFileStream(object):
+    """
+    A file stream for log lines that writes through a large userspace buffer
+    and rotates the file by size and/or time. Rotation flushes and renames
+    the current file to ``<filename>.<YYYYmmdd-HHMMSS>`` (plus ``.<n>`` for
+    further rotations within the same second) and reopens ``filename``,
+    rotated segments are gzipped (and the oldest archives removed) by a
+    background thread so emitters never wait for compression.
+    :param filename: The path of the log file.
+    :param max_bytes: Rotate once the file holds this many characters
+                      (``0`` disables size rotation).
+    :param interval: Rotate every ``interval`` seconds, aligned on the epoch,
+                     e.g. ``3600`` rotates on the hour (``0`` disables time
+                     rotation).
+    :param backup_count: The number of archives (gzipped segments, or rotated
+                         segments without ``compress``) to keep, ``0`` keeps
+                         all of them.
+    :param compress: ``True`` gzips rotated segments.
+    :param buffer_size: The size of the userspace write buffer in bytes.
+    :param flush_interval: Flush from :py:meth:`write` once the buffer has
+                           held data for this many seconds.
+    """
+
+    segment_suffix = re.compile(r'(\d{8}-\d{6})(?:\.(\d+))?(\.gz)?$')
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=0, compress=True,
+                 buffer_size=1024 * 1024, flush_interval=1.0, encoding='utf-8'):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.encoding = encoding
+        self._archive_queue = collections.deque()
+        self._archive_ready = threading.Condition(threading.Lock())
+        self._archiver = None
+        self._last_segment = None  # (timestamp, n) of the last rotation
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = io.open(self.filename, 'a', buffering=self.buffer_size, encoding=self.encoding)
+        self._size = self._file.tell()
+        now = time.time()
+        self._rotate_at = (now // self.interval + 1) * self.interval if self.interval else None
+        self._flush_at = None
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        if self._rotate_at is not None and time.time() >= self._rotate_at or \
+                self.max_bytes and self._size and self._size + len(text) > self.max_bytes:
+            self.rotate()
+        self._file.write(text)
+        self._size += len(text)
+        if self._flush_at is None:
+            self._flush_at = time.time() + self.flush_interval
+        elif time.time() >= self._flush_at:
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        self._flush_at = None
+
+    def rotate(self):
+        """
+        Close the current file, rename it and open a new one. The renamed
+        segment is handed to the archiver thread. The file is reopened even
+        if the rename fails, so later writes don't hit a closed file.
+        """
+        self._file.close()
+        try:
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            # Never reuse a name within the second, even once its archive was pruned.
+            n = self._last_segment[1] + 1 if self._last_segment and self._last_segment[0] == stamp else 0
+            while True:
+                segment = '%s.%s' % (self.filename, stamp) if not n else '%s.%s.%d' % (self.filename, stamp, n)
+                if not os.path.exists(segment) and not os.path.exists(segment + '.gz'):
+                    break
+                n += 1
+            self._last_segment = (stamp, n)
+            os.rename(self.filename, segment)
+        finally:
+            self._open()
+        if self.compress or self.backup_count:
+            with self._archive_ready:
+                self._archive_queue.append(segment)
+                self._archive_ready.notify()
+            if self._archiver is None:
+                self._archiver = threading.Thread(target=self._archive, name='RotatingFileStream')
+                self._archiver.daemon = True
+                self._archiver.start()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._archiver is not None:
+            with self._archive_ready:
+                self._archive_queue.append(None)
+                self._archive_ready.notify()
+            self._archiver.join()
+            self._archiver = None
+
+    def _archive(self):
+        while True:
+            with self._archive_ready:
+                while not self._archive_queue:
+                    self._archive_ready.wait()
+                segment = self._archive_queue.popleft()
+            if segment is None:
+                return
+            try:
+                if self.compress:
+                    with open(segment, 'rb') as src, gzip.open(segment + '.gz', 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                    os.remove(segment)
+                if self.backup_count:
+                    for old in self.archives()[:-self.backup_count]:
+                        try:
+                            os.remove(old)
+                        except FileNotFoundError:
+                            pass
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc(file=sys.__stderr__)
+
+    def archives(self):
+        """
+        The finished archives, oldest rotation first: the gzipped segments,
+        or the rotated ones without ``compress``. Raw segments still waiting
+        for compression are not archives yet.
+        """
+        prefix = self.filename + '.'
+        archives = []
+        for path in glob.glob(glob.escape(self.filename) + '.*'):
+            match = self.segment_suffix.match(path[len(prefix):])
+            if match and bool(match.group(3)) == bool(self.compress):
+                archives.append(((match.group(1), int(match.group(2) or 0)), path))
+        archives.sort()
+        return [path for _, path in archives]
+
+
+class SocketStream(object):
+    """
+    A write-only stream sending text to a Unix (``address`` is a path) or
+    TCP (``address`` is a ``(host, port)`` tuple) socket. Connecting and
+    sending time out, after a failure the connection is retried at most
+    every ``retry_interval`` seconds and text written meanwhile is dropped,
+    so a writer never waits on a missing or stuck peer for longer than the
+    timeouts. Dropped lines are counted and reported through
+    ``dropped_line`` (see :py:class:`BackgroundWriter`) once reconnected.
+    """
+
+    def __init__(self, address, connect_timeout=1.0, send_timeout=1.0, retry_interval=1.0, dropped_line=None):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.retry_interval = retry_interval
+        self.dropped_line = dropped_line
+        self.dropped = 0
+        self._dropped = 0
+        self._sock = None
+        self._retry_at = 0
+
+    def isatty(self):
+        return False
+
+    def _connect(self):
+        if self._sock is None and time.time() >= self._retry_at:
+            family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.connect_timeout)
+                sock.connect(self.address)
+                sock.settimeout(self.send_timeout)
+            except (socket.error, OSError):
+                sock.close()
+                self._retry_at = time.time() + self.retry_interval
+            else:
+                self._sock = sock
+        return self._sock
+
+    def write(self, text):
+        sock = self._connect()
+        if sock is not None:
+            if self._dropped and self.dropped_line is not None:
+                text = self.dropped_line(self._dropped) + text
+            try:
+                sock.sendall(text.encode('utf-8'))
+            except (socket.error, OSError):
+                self.close()
+                self._retry_at = time.time() + self.retry_interval
+            else:
+                self._dropped = 0
+                return
+        lines = text.count('\n')
+        self._dropped += lines
+        self.dropped += lines
+
+    def flush(self):
+        pass
+
+    def after_fork(self):
+        """Called in a forked child, which connects on its own."""
+        self.close()  # only the child's descriptor, the parent stays connected
+        self._retry_at = 0
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class JsonRecordEncoder(object):
+    """
+    Encode log records into the JSON lines written when ``no_color`` is set::
+        {"message": "...", "level": "INFO", "timestamp": "2017-03-30T16:03:43.808628", "fields": {...}}
+    The output is what :py:func:`json.dumps()` produces for the same object,
+    but the constant parts are concatenated from cached, already encoded
+    fragments: one per level name, one per field name and the timestamp up
+    to the second, which is rebuilt once per second from ``record.created``.
+    Fields whose values are all of type ``str``, ``int``, ``float``, ``bool``
+    or ``None`` are encoded inline, any other value sends the whole ``fields``
+    dictionary through :py:func:`json.dumps()` with ``default=str``.
+    """
+
+    max_cached_keys = 1024
+
+    def __init__(self):
+        self._levels = {}
+        self._keys = {}
+        self._second = None
+        self._second_text = None
+        self._value_encoders = {
+            str: encode_basestring_ascii,
+            int: int.__repr__,
+            float: self._encode_float,
+            bool: self._encode_bool,
+            type(None): self._encode_none,
+        }
+
+    def encode(self, record, message):
+        """
+        Encode a record with the given (formatted) message text.
+        """
+        level = self._levels.get(record.levelname)
+        if level is None:
+            level = self._levels[record.levelname] = \
+                ', "level": %s, "timestamp": "' % encode_basestring_ascii(record.levelname)
+        created = record.created
+        second = int(created)
+        if second != self._second:
+            self._second_text = datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%dT%H:%M:%S.')
+            self._second = second
+        fields = self.encode_record_fields(record)
+        if fields is not None:
+            tail = '", "fields": %s}' % fields
+        else:
+            tail = '"}'
+        return ''.join(('{"message": ', encode_basestring_ascii(message), level,
+                        self._second_text, '%06d' % ((created - second) * 1000000), tail))
+
+    def encode_record_fields(self, record):
+        """
+        Encode the fields of a record as a JSON object, ``None`` when it has no
+        ``fields`` dictionary. The context fields of a :py:class:`BoundLogger`
+        are spliced in from their cached encoding unless a field of the call
+        overrides one of them.
+        """
+        fields = getattr(record, 'fields', None)
+        bound_logger = getattr(record, 'bound_logger', None)
+        if bound_logger is not None and bound_logger.fields:
+            if not fields:
+                return '{%s}' % bound_logger.encoded_fields(self)
+            bound_fields = bound_logger.fields
+            for key in fields:
+                if key in bound_fields:
+                    return '{%s}' % self.encode_fields(record_fields(record))
+            return '{%s, %s}' % (bound_logger.encoded_fields(self), self.encode_fields(fields))
+        if isinstance(fields, dict):
+            return '{%s}' % self.encode_fields(fields)
+        return None
+
+    def encode_fields(self, fields):
+        """
+        Encode the members of a ``fields`` dictionary (without the braces).
+        """
+        parts = []
+        keys = self._keys
+        value_encoders = self._value_encoders
+        for key, value in fields.items():
+            key_text = keys.get(key)
+            if key_text is None:
+                key_text = json.dumps({key: 0})[1:-4]
+                if len(keys) >= self.max_cached_keys:
+                    keys.clear()
+                keys[key] = key_text = key_text + ': '
+            value_encoder = value_encoders.get(type(value))
+            if value_encoder is None:
+                return json.dumps(fields, default=str)[1:-1]
+            parts.append(key_text + value_encoder(value))
+        return ', '.join(parts)
+
+    @staticmethod
+    def _encode_float(value):
+        if value != value:
+            return 'NaN'
+        elif value == float('inf'):
+            return 'Infinity'
+        elif value == -float('inf'):
+            return '-Infinity'
+        return float.__repr__(value)
+
+    @staticmethod
+    def _encode_bool(value):
+        return 'true' if value else 'false'
+
+    @staticmethod
+    def _encode_none(value):
+        return 'null'
+
+
 class ColoredStreamHandler(logging.StreamHandler):
     """
     The :py:class:`ColoredStreamHandler` class enables colored terminal output
@@ -174,6 +882,9 @@ class ColoredStreamHandler(logging.StreamHandler):
 
     default_severity_to_style.update(user_defined_seversity)
 
+    max_cached_styles = 1024
+    flush_each_record = True
+
     def __init__(self, stream=sys.stderr, level=logging.NOTSET, isatty=None,
                  show_name=True, show_severity=True, show_timestamps=True,
                  show_hostname=True, use_chroot=True, severity_to_style=None, no_color=False):
@@ -197,8 +908,15 @@ class ColoredStreamHandler(logging.StreamHandler):
                 self.isatty = False
 
         self._no_color = no_color
+        self.json_encoder = JsonRecordEncoder()
+        self.writer = None
+        self._drop_notice_handler = None
+        self._cache_timestamps = type(self).render_timestamp == ColoredStreamHandler.render_timestamp
+        self._timestamp_second = None
+        self._timestamp_text = None
+        self._reset_render_plans()
         
-        if sys.version < (3, 0, 0):
+        if sys.version_info < (3, 0, 0):
             self.terminator = '\n'
             
     def emit(self, record):
@@ -209,6 +927,14 @@ class ColoredStreamHandler(logging.StreamHandler):
         # If the message doesn't need to be rendered we take a shortcut.
         if record.levelno < self.level:
             return
+        # Use the built-in stream handler to handle output.
+        self._emit(record)
+
+    def _prepare(self, record):
+        """
+        Return a copy of the record whose message carries the colors,
+        timestamp, source location and logger name.
+        """
         # Make sure the message is a string.
         message = record.msg
         try:
@@ -246,8 +972,7 @@ class ColoredStreamHandler(logging.StreamHandler):
         # Copy the original record so we don't break other handlers.
         record = copy.copy(record)
         record.msg = message
-        # Use the built-in stream handler to handle output.
-        self._emit(record)
+        return record
 
     def _emit(self, record):
         """
@@ -261,30 +986,182 @@ class ColoredStreamHandler(logging.StreamHandler):
         output to the stream.
         """
         try:
-            msg = self.format(record)
+            msg = self._format_line(record)
+            if self.writer is not None:
+                self.writer.put(msg + self.terminator)
+            else:
+                stream = self.stream
+                stream.write(msg)
+                stream.write(self.terminator)
+                if self.flush_each_record:
+                    self.flush()
+        except Exception:
+            self.handleError(record)
 
-            if self._no_color:
-                # 生产环境 无颜色
-                foo = {"message": msg, "level": record.levelname, "timestamp": datetime.datetime.now().isoformat()}
-                if hasattr(record, 'fields') and isinstance(record.fields, dict):
-                    foo['fields'] = record.fields
+    def _format_line(self, record):
+        """
+        Format a record into a single output line (without the terminator).
+        """
+        if self._no_color:
+            # 生产环境 无颜色
+            return self.json_encoder.encode(record, self._json_message(record))
 
-                msg = json.dumps(foo, default=str)
+        if self._is_plain(record):
+            return self._render_colored(record)
 
-            else:
-                if hasattr(record, 'fields') and isinstance(record.fields, dict):
-                    msg += '\t'
-                    msg += ' '.join(
-                        map(lambda x: '%s=%s' % (self.wrap_style(x[0], color='blue'), x[1]), record.fields.items()))
+        record = self._prepare(record)
+        msg = self.format(record)
+        fields = record_fields(record)
+        if isinstance(fields, dict):
+            msg += '\t'
+            msg += ' '.join(
+                map(lambda x: '%s=%s' % (self.wrap_style(x[0], color='blue'), x[1]), fields.items()))
 
-                    msg = '[%s] ' % record.levelname + msg
+            msg = '[%s] ' % record.levelname + msg
+        return msg
 
-            stream = self.stream
-            stream.write(msg)
-            stream.write(self.terminator)
-            self.flush()
-        except Exception:
-            self.handleError(record)
+    def _is_plain(self, record):
+        """
+        Whether the record can skip the copy made by :py:meth:`_prepare` and
+        the formatter: no formatter is set and there is no exception or stack
+        text to append.
+        """
+        return (self.formatter is None and not record.exc_info and not record.exc_text
+                and not getattr(record, 'stack_info', None))
+
+    def _plain_message(self, record):
+        message = record.msg
+        if not isinstance(message, str):
+            message = message.__repr__()
+        if record.args:
+            message = message % record.args
+        return message
+
+    def _json_message(self, record):
+        """
+        The message text of a JSON record.
+        """
+        if self._is_plain(record):
+            return self._plain_message(record)
+        return self.format(self._prepare(record))
+
+    def _render_colored(self, record):
+        """
+        Render a plain record in the colored format without copying it. The
+        styling is taken from a render plan compiled once per level name (see
+        :py:meth:`_compile_render_plan`), styled logger names and field names
+        are cached and the timestamp is rendered once per second. The output
+        is identical to :py:meth:`_prepare` followed by the formatter.
+        """
+        if self._render_options != (self.isatty, self.show_timestamps):
+            self._reset_render_plans()
+        levelname = record.levelname
+        plan = self._render_plans.get(levelname)
+        if plan is None:
+            plan = self._compile_render_plan(levelname)
+        timestamp_open, timestamp_close, message_open, message_close = plan
+
+        name = self._styled_names.get(record.name)
+        if name is None:
+            if len(self._styled_names) >= self.max_cached_styles:
+                self._styled_names.clear()
+            name = self._styled_names[record.name] = self.wrap_style(text=record.name, color='cyan')
+
+        fields = record_fields(record)
+        if not isinstance(fields, dict):
+            fields = None
+        parts = []
+        if fields is not None:
+            parts.append('[%s] ' % levelname)
+        if timestamp_open is not None:
+            created = record.created
+            if self._timestamp_second != int(created) or not self._cache_timestamps:
+                self._timestamp_text = self.render_timestamp(created)
+                self._timestamp_second = int(created)
+            parts.extend((timestamp_open, self._timestamp_text, '] ', record.filename, ':', str(record.lineno),
+                          timestamp_close, ' '))
+        parts.extend((name, ' ', message_open, self._plain_message(record), message_close))
+        if fields is not None:
+            parts.append('\t')
+            styled_keys = self._styled_keys
+            items = []
+            for key, value in fields.items():
+                styled_key = styled_keys.get(key)
+                if styled_key is None:
+                    if len(styled_keys) >= self.max_cached_styles:
+                        styled_keys.clear()
+                    styled_key = styled_keys[key] = self.wrap_style(key, color='blue')
+                items.append('%s=%s' % (styled_key, value))
+            parts.append(' '.join(items))
+        return ''.join(parts)
+
+    def _compile_render_plan(self, levelname):
+        """
+        Build the render plan of a level name: the text around the timestamp
+        and location (``None`` when timestamps are hidden) and the escape
+        sequences around the message.
+        """
+        if self.show_timestamps:
+            timestamp_open, timestamp_close = self.wrap_style(text='[\0', color='green').split('\0')
+        else:
+            timestamp_open = timestamp_close = None
+        if levelname in self.severity_to_style:
+            message_open, message_close = self.wrap_style(text='\0', **self.severity_to_style[levelname]).split('\0')
+        else:
+            message_open = message_close = ''
+        plan = self._render_plans[levelname] = (timestamp_open, timestamp_close, message_open, message_close)
+        return plan
+
+    def _reset_render_plans(self):
+        self._render_options = (self.isatty, self.show_timestamps)
+        self._render_plans = {}
+        self._styled_names = {}
+        self._styled_keys = {}
+
+    def start_background_writer(self, **kw):
+        """
+        Hand all further output to a :py:class:`BackgroundWriter` so logging
+        calls only format the record and queue the line.
+        :param kw: Optional keyword arguments for :py:class:`BackgroundWriter`.
+        """
+        if self.writer is None:
+            self.writer = BackgroundWriter(self.stream, dropped_line=self._dropped_line, **kw)
+        return self.writer
+
+    def _dropped_line(self, count):
+        record = logging.LogRecord(self.__class__.__name__, logging.WARNING, __file__, 0,
+                                   'dropped %d log records, the background writer queue is full', (count,), None)
+        record.fields = {'dropped': count}
+        # Called on the writer thread, which must not take the handler lock
+        # (close() joins it under that lock) nor share the caches of the
+        # emitting threads: format with a copy having caches of its own.
+        handler = self._drop_notice_handler
+        if handler is None:
+            handler = copy.copy(self)
+            handler.json_encoder = JsonRecordEncoder()
+            handler._timestamp_second = None
+            handler._reset_render_plans()
+            self._drop_notice_handler = handler
+        return handler._format_line(record) + self.terminator
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+        else:
+            logging.StreamHandler.flush(self)
+
+    def addFilter(self, filter):
+        logging.StreamHandler.addFilter(self, filter)
+        if isinstance(filter, RateLimitFilter):
+            filter.handler = self
+
+    def close(self):
+        for filter in self.filters:
+            if isinstance(filter, RateLimitFilter) and filter.handler is self:
+                filter.flush_suppressed(force=True)
+        if self.writer is not None:
+            self.writer.close()
+        logging.StreamHandler.close(self)
 
     def render_timestamp(self, created):
         """
@@ -312,27 +1189,431 @@ class ColoredStreamHandler(logging.StreamHandler):
         return ansi_text(text, **kw) if self.isatty else text
 
 
-def install(level=logging.FATAL, no_color=False, **kw):
+class _TokenBucket(object):
+    __slots__ = ('tokens', 'last', 'suppressed', 'sample')
+
+    def __init__(self, tokens, last):
+        self.tokens = tokens
+        self.last = last
+        self.suppressed = 0
+        self.sample = None  # the last suppressed record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limit the rate of records per call site or per message template with a
+    token bucket: a key may log ``burst`` records at once and ``rate``
+    records per second after that. Records over the limit are dropped and
+    counted, and the next record of the key that gets through carries the
+    number of records collapsed into it as ``fields['repeated']``. With
+    ``rate=1.0 / 60, burst=1`` a message repeated all the time shows up once
+    a minute together with the number of repeats in between.
+
+    When the storm stops, the count is not lost: once a key could log again
+    (checked on the next record of any key) or when the handler is closed,
+    the last suppressed record is emitted with ``fields['repeated']`` set to
+    the number of records suppressed. The filter emits it through the
+    handler it's added to, or through the record's logger when it's added
+    to a logger.
+
+    The filter takes no lock, buckets are updated racily (a concurrent
+    update may lose a token or a count) in exchange for a fast path of one
+    dictionary lookup and a little arithmetic. Time is read from
+    ``record.created``.
+    :param rate: The number of records per second a key refills.
+    :param burst: The number of records a key may log at once.
+    :param key: ``callsite`` (the file and line of the log call, which
+                needs caller info, see :py:func:`set_caller_info()`; with
+                ``caller_info='off'`` it falls back to ``template``),
+                ``template`` (the logger name and the unformatted message)
+                or a function mapping a record to a hashable key.
+    """
+
+    max_keys = 10000
+
+    def __init__(self, rate=10.0, burst=20, key='callsite'):
+        logging.Filter.__init__(self)
+        if key == 'callsite':
+            self.key = self.callsite_key
+        elif key == 'template':
+            self.key = self.template_key
+        elif callable(key):
+            self.key = key
+        else:
+            raise ValueError("Invalid key %r! (expected callsite, template or a function)" % (key,))
+        self.rate = float(rate)
+        self.burst = burst
+        self.suppressed = 0
+        self.handler = None  # set by ColoredStreamHandler.addFilter()
+        self._buckets = {}
+        self._pending = {}  # key: bucket with suppressed records
+        self._next_flush = float('inf')
+        self._flush_lock = threading.Lock()
+
+    @staticmethod
+    def callsite_key(record):
+        if not record.lineno:
+            # No caller info, every record would share one bucket.
+            return RateLimitFilter.template_key(record)
+        return record.pathname, record.lineno
+
+    @staticmethod
+    def template_key(record):
+        msg = record.msg
+        return record.name, msg if isinstance(msg, str) else repr(msg)
+
+    def filter(self, record):
+        if self._pending and record.created >= self._next_flush:
+            self.flush_suppressed(record.created)
+        key = self.key(record)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self.flush_suppressed(record.created, force=True)
+                self._buckets.clear()
+            bucket = self._buckets.setdefault(key, _TokenBucket(self.burst, record.created))
+        elapsed = record.created - bucket.last
+        tokens = bucket.tokens
+        if elapsed > 0:
+            bucket.last = record.created
+            tokens = min(tokens + elapsed * self.rate, self.burst)
+        if tokens < 1:
+            bucket.tokens = tokens
+            bucket.suppressed += 1
+            bucket.sample = record
+            self.suppressed += 1
+            if key not in self._pending:
+                self._pending[key] = bucket
+                self._next_flush = min(self._next_flush, self._refilled_at(bucket))
+            return False
+        bucket.tokens = tokens - 1
+        if bucket.suppressed:
+            self._pending.pop(key, None)
+            bucket.sample = None
+            repeated, bucket.suppressed = bucket.suppressed, 0
+            fields = getattr(record, 'fields', None)
+            if isinstance(fields, dict):
+                fields['repeated'] = repeated
+            else:
+                record.fields = {'repeated': repeated}
+        return True
+
+    def _refilled_at(self, bucket):
+        """When the bucket holds a token again."""
+        if self.rate <= 0:
+            return float('inf')
+        return bucket.last + (1 - bucket.tokens) / self.rate
+
+    def flush_suppressed(self, now=None, force=False):
+        """
+        Emit the count of every key whose window is over (every key with
+        ``force``) as a copy of its last suppressed record.
+        """
+        if not self._flush_lock.acquire(False):
+            return  # another thread is at it
+        try:
+            now = time.time() if now is None else now
+            next_flush = float('inf')
+            for key, bucket in list(self._pending.items()):
+                refilled_at = self._refilled_at(bucket)
+                if not force and refilled_at > now:
+                    next_flush = min(next_flush, refilled_at)
+                    continue
+                del self._pending[key]
+                sample, repeated = bucket.sample, bucket.suppressed
+                bucket.sample, bucket.suppressed = None, 0
+                if sample is not None and repeated:
+                    self._emit_summary(sample, repeated)
+            self._next_flush = next_flush
+        finally:
+            self._flush_lock.release()
+
+    def _emit_summary(self, sample, repeated):
+        summary = copy.copy(sample)
+        fields = getattr(sample, 'fields', None)
+        summary.fields = dict(fields) if isinstance(fields, dict) else {}
+        summary.fields['repeated'] = repeated
+        handler = self.handler
+        if handler is None:
+            logging.getLogger(summary.name).callHandlers(summary)
+            return
+        handler.acquire()
+        try:
+            handler.emit(summary)
+        finally:
+            handler.release()
+
+
+class ColoredFileHandler(ColoredStreamHandler):
+    """
+    A :py:class:`ColoredStreamHandler` writing the same colored (without
+    escape sequences) or JSON lines to a :py:class:`RotatingFileStream`.
+    Lines are not flushed one by one, the stream flushes by buffer size and
+    ``flush_interval``; pair it with :py:meth:`start_background_writer()`
+    to also flush when no more records arrive.
+    :param filename: The path of the log file.
+    :param max_bytes, interval, backup_count, compress, buffer_size,
+           flush_interval, encoding: See :py:class:`RotatingFileStream`.
+    :param kw: Optional keyword arguments for :py:class:`ColoredStreamHandler`.
+    """
+
+    flush_each_record = False
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=0, compress=True,
+                 buffer_size=1024 * 1024, flush_interval=1.0, encoding='utf-8', **kw):
+        stream = RotatingFileStream(filename, max_bytes=max_bytes, interval=interval, backup_count=backup_count,
+                                    compress=compress, buffer_size=buffer_size, flush_interval=flush_interval,
+                                    encoding=encoding)
+        ColoredStreamHandler.__init__(self, stream, **kw)
+
+    def close(self):
+        ColoredStreamHandler.close(self)
+        self.stream.close()
+
+
+class ForwardingHandler(ColoredStreamHandler):
+    """
+    Send records to a :py:class:`LogAggregator` instead of formatting and
+    writing them in this process. Every record becomes one compact JSON line
+    (creation time, level, logger name, location, formatted message and
+    ``fields``) queued on a :py:class:`BackgroundWriter`, whose thread sends
+    batches over a single :py:class:`SocketStream` connection, so the records
+    of a process arrive in order. By default a full queue drops the newest
+    records, and the socket never blocks for longer than its timeouts.
+    :param address: The aggregator's Unix socket path or ``(host, port)``.
+    :param connect_timeout, send_timeout, retry_interval: See
+           :py:class:`SocketStream`.
+    :param kw: Optional keyword arguments for :py:class:`BackgroundWriter`.
+    """
+
+    def __init__(self, address, level=logging.NOTSET, connect_timeout=1.0, send_timeout=1.0,
+                 retry_interval=1.0, **kw):
+        stream = SocketStream(address, connect_timeout=connect_timeout, send_timeout=send_timeout,
+                              retry_interval=retry_interval)
+        ColoredStreamHandler.__init__(self, stream, level=level, isatty=False, no_color=True)
+        stream.dropped_line = self._dropped_line
+        kw.setdefault('full_policy', 'drop_newest')
+        self.start_background_writer(**kw)
+
+    def _format_line(self, record):
+        fields = self.json_encoder.encode_record_fields(record)
+        return '[%r,%d,%s,%s,%s,%d,%s,%s]' % (
+            record.created, record.levelno, encode_basestring_ascii(record.levelname),
+            encode_basestring_ascii(record.name), encode_basestring_ascii(record.filename), record.lineno or 0,
+            encode_basestring_ascii(self._json_message(record)),
+            'null' if fields is None else fields)
+
+    def close(self):
+        ColoredStreamHandler.close(self)
+        self.stream.close()
+
+
+class LogAggregator(object):
+    """
+    Receive the records of many :py:class:`ForwardingHandler` processes on a
+    Unix or TCP socket and pass them to one handler, typically a
+    :py:class:`ColoredStreamHandler` or :py:class:`ColoredFileHandler` with a
+    background writer, which formats them and writes them in batches. Lines
+    never interleave or tear, and records of one process keep their order.
+    """
+
+    def __init__(self, address, handler, backlog=128):
+        self.address = address
+        self.handler = handler
+        self.backlog = backlog
+        self._running = False
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Accept connections and handle records until :py:meth:`shutdown()`.
+        """
+        import selectors
+
+        if isinstance(self.address, tuple):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        listener.bind(self.address)
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        self._running = True
+        try:
+            while self._running:
+                for key, _ in selector.select(poll_interval):
+                    if key.fileobj is listener:
+                        try:
+                            conn, _ = listener.accept()
+                        except (socket.error, OSError):
+                            continue
+                        conn.setblocking(False)
+                        selector.register(conn, selectors.EVENT_READ, [b''])
+                    else:
+                        self._read(selector, key.fileobj, key.data)
+            # Drain what connected processes have sent so far.
+            for key in list(selector.get_map().values()):
+                if key.fileobj is not listener:
+                    while self._read(selector, key.fileobj, key.data):
+                        pass
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+            if not isinstance(self.address, tuple) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def shutdown(self):
+        self._running = False
+
+    def _read(self, selector, conn, pending):
+        try:
+            data = conn.recv(256 * 1024)
+        except (socket.error, OSError):
+            data = None
+        if not data:
+            # A torn last line of a closed connection is dropped.
+            selector.unregister(conn)
+            conn.close()
+            return False
+        lines = (pending[0] + data).split(b'\n')
+        pending[0] = lines.pop()
+        for line in lines:
+            try:
+                record = self.parse(line)
+            except Exception:
+                continue
+            self.handler.handle(record)
+        return True
+
+    @staticmethod
+    def parse(line):
+        """
+        Rebuild a :py:class:`logging.LogRecord` from a line sent by
+        :py:class:`ForwardingHandler`.
+        """
+        created, levelno, levelname, name, filename, lineno, message, fields = json.loads(line.decode('utf-8'))
+        record = logging.makeLogRecord({
+            'name': name, 'levelno': levelno, 'levelname': levelname, 'pathname': filename, 'filename': filename,
+            'lineno': lineno, 'msg': message, 'created': created, 'msecs': (created - int(created)) * 1000,
+        })
+        if fields is not None:
+            record.fields = fields
+        return record
+
+
+def run_aggregator(address, filename=None, background=True, **kw):
+    """
+    Run a :py:class:`LogAggregator` in this process until SIGTERM or SIGINT,
+    writing to ``filename`` (with a :py:class:`ColoredFileHandler`) or to
+    standard error.
+    :param background: ``True`` or a dictionary of keyword arguments for the
+                       handler's :py:class:`BackgroundWriter`.
+    :param kw: Optional keyword arguments for the handler.
+    """
+    if filename:
+        handler = ColoredFileHandler(filename, **kw)
+    else:
+        handler = ColoredStreamHandler(**kw)
+    if background:
+        handler.start_background_writer(**(background if isinstance(background, dict) else {}))
+    aggregator = LogAggregator(address, handler)
+
+    def stop(signum, frame):
+        aggregator.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        aggregator.serve_forever()
+    finally:
+        handler.close()
+
+
+def start_aggregator(address, **kw):
+    """
+    Start :py:func:`run_aggregator()` in a child process and return the
+    :py:class:`multiprocessing.Process`. Worker processes then log to it
+    with ``install(aggregate=address)``.
+    """
+    import multiprocessing
+
+    process = multiprocessing.Process(target=run_aggregator, args=(address,), kwargs=kw, name='LogAggregator')
+    process.daemon = True
+    process.start()
+    return process
+
+
+def install(level=None, no_color=None, background=None, caller_info=None, rate_limit=None,
+            filename=None, aggregate=None, **kw):
     """
     Install a :py:class:`ColoredStreamHandler` for the root logger. Calling
-    this function multiple times will never install more than one handler.
+    this function multiple times will never install more than one handler:
+    a call with other options than the current handler's (including the one
+    installed on import) replaces it, a call with the same options does
+    nothing. Options left out default to those of the import time install.
     :param level: The logging level to filter on (defaults to :py:data:`logging.INFO`).
+    :param background: ``True`` or a dictionary of keyword arguments for
+                       :py:class:`BackgroundWriter` to write from a dedicated
+                       thread instead of the logging thread.
+    :param caller_info: How log calls look up their caller, see
+                        :py:func:`set_caller_info()`.
+    :param rate_limit: ``True`` or a dictionary of keyword arguments for a
+                       :py:class:`RateLimitFilter` in front of the handler.
+    :param filename: Install a :py:class:`ColoredFileHandler` writing to this
+                     file instead (``kw`` may then include its rotation
+                     options).
+    :param aggregate: Install a :py:class:`ForwardingHandler` sending records
+                      to the :py:class:`LogAggregator` at this address
+                      instead, ``background`` then configures its queue.
     :param kw: Optional keyword arguments for :py:class:`ColoredStreamHandler`.
     """
-    global root_handler
-    if not root_handler:
-        # Create the root handler.
-        root_handler = ColoredStreamHandler(level=level, no_color=no_color, **kw)
-        # Install the root handler.
-        root_logger = logging.getLogger()
-        root_logger.setLevel(logging.NOTSET)
-        root_logger.addHandler(root_handler)
+    global root_handler, _root_handler_config
+    if caller_info is not None:
+        set_caller_info(caller_info)
+        if root_handler is not None and level is None and no_color is None and background is None \
+                and rate_limit is None and filename is None and aggregate is None and not kw:
+            return  # only the caller lookup changes
+    options = dict(_install_defaults, **kw)
+    if level is not None:
+        options['level'] = level
+    if no_color is not None:
+        options['no_color'] = no_color
+    config = (options, background, rate_limit, filename, aggregate)
+    if root_handler is not None and config == _root_handler_config:
+        return
+    # Create the root handler.
+    if aggregate:
+        handler = ForwardingHandler(aggregate, level=options['level'],
+                                    **(background if isinstance(background, dict) else {}))
+    elif filename:
+        handler = ColoredFileHandler(filename, **options)
+    else:
+        handler = ColoredStreamHandler(**options)
+    if background and not aggregate:
+        handler.start_background_writer(**(background if isinstance(background, dict) else {}))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(**(rate_limit if isinstance(rate_limit, dict) else {})))
+    # Install the root handler, in place of the previous one.
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.NOTSET)
+    root_logger.addHandler(handler)
+    if root_handler is not None:
+        root_logger.removeHandler(root_handler)
+        root_handler.close()
+    root_handler = handler
+    _root_handler_config = config
 
 
 # Initialize coloredlogs.
 
 # print json log if no_color = 0 else colored logs
-install(level=logging.INFO, show_hostname=False, show_name=False, no_color=0)
+_install_defaults = dict(level=logging.INFO, show_hostname=False, show_name=False, no_color=0)
+_root_handler_config = None
+install()
 
 
 if __name__ == '__main__':
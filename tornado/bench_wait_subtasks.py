@@ -0,0 +1,349 @@
+# coding=utf-8
+"""Benchmarks and checks for wait_subtasks.
+
+Usage:
+    python bench_wait_subtasks.py fan-in [--subtasks N,...] [--memory]
+    python bench_wait_subtasks.py timeouts [--waiters N,...] [--span SECONDS]
+    python bench_wait_subtasks.py check [--rounds N] [--waiters N]
+
+`fan-in` starts --subtasks subtasks (each yields to the loop once) and
+waits for all of them with ProcessWaiter, InstrumentedProcessWaiter,
+FanOut, `gen.multi`, `asyncio.gather` and a counter plus an
+`asyncio.Event`. It reports subtasks/sec, the wake-up latency from the
+last subtask done to the waiter running again and, with --memory, the
+peak traced memory per subtask (tracemalloc slows the run down).
+
+`timeouts` registers --waiters `wait_all_done` calls with deadlines spread
+over --span seconds on one ProcessWaiter, lets the first half time out and
+wakes the rest with `done()`. It reports the registration cost per waiter,
+the CPU time of the whole run and the peak length of `_waiters`, for
+ProcessWaiter and for LegacyProcessWaiter (one `IOLoop.add_timeout` per
+waiter, as it was before the shared timer slots).
+
+`check` races timeouts against completions: waiters with random deadlines
+around the moment the counter gets back to zero, some cancelled by their
+caller. Every waiter must end up woken, or timed out no earlier than its
+deadline and no later than `timer_resolution` (plus the loop's lag) after
+it, without any error in the IOLoop. It also makes sure a FanOut left with
+unread results (a `break` out of its loop, `aclose()`) doesn't hang
+`wait_all_done`, never counts more than `limit` subtasks at once and
+rejects a `limit` below 1. Exits with status 1 otherwise.
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+import tornado.gen
+import tornado.ioloop
+import tornado.locks
+from tornado.concurrent import Future
+
+from wait_subtasks import FanOut, InstrumentedProcessWaiter, ProcessWaiter
+
+
+class LegacyProcessWaiter(tornado.locks._TimeoutGarbageCollector):
+    """ProcessWaiter with one IOLoop timeout per waiter, for comparison."""
+
+    def __init__(self):
+        super(LegacyProcessWaiter, self).__init__()
+        self._value = 0
+
+    def processing(self):
+        self._value -= 1
+
+    def done(self):
+        self._value += 1
+        if self._value == 0:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def wait_all_done(self, timeout=None):
+        waiter = Future()
+        if self._value == 0:
+            waiter.set_result(None)
+        else:
+            self._waiters.append(waiter)
+            if timeout:
+                def on_timeout():
+                    # remove_timeout runs in a later callback, the waiter may be woken already.
+                    if waiter.done():
+                        return
+                    waiter.set_exception(tornado.gen.TimeoutError())
+                    self._garbage_collect()
+                io_loop = tornado.ioloop.IOLoop.current()
+                timeout_handle = io_loop.add_timeout(timeout, on_timeout)
+                waiter.add_done_callback(
+                    lambda _: io_loop.remove_timeout(timeout_handle))
+        return waiter
+
+
+class State(object):
+    last_done = 0.0
+
+
+async def subtask(state):
+    await asyncio.sleep(0)
+    state.last_done = time.perf_counter()
+
+
+async def waited_subtask(state, waiter):
+    try:
+        await subtask(state)
+    finally:
+        waiter.done()
+
+
+async def fan_in_process_waiter(subtasks, state, waiter_class=ProcessWaiter):
+    waiter = waiter_class()
+    for _ in range(subtasks):
+        # Counted before the subtask runs, or the waiter could see zero in between.
+        waiter.processing()
+        asyncio.ensure_future(waited_subtask(state, waiter))
+    await waiter.wait_all_done()
+    return waiter
+
+
+async def fan_in_instrumented(subtasks, state):
+    return await fan_in_process_waiter(subtasks, state, InstrumentedProcessWaiter)
+
+
+async def fan_in_fan_out(subtasks, state, limit=None):
+    await FanOut(limit=limit).map(subtask, itertools.repeat(state, subtasks)).wait_all_done()
+
+
+async def fan_in_fan_out_limited(subtasks, state):
+    await fan_in_fan_out(subtasks, state, limit=1000)
+
+
+async def fan_in_multi(subtasks, state):
+    await tornado.gen.multi([subtask(state) for _ in range(subtasks)])
+
+
+async def fan_in_gather(subtasks, state):
+    await asyncio.gather(*[subtask(state) for _ in range(subtasks)])
+
+
+async def fan_in_event(subtasks, state):
+    remaining = subtasks
+    all_done = asyncio.Event()
+
+    async def counted():
+        nonlocal remaining
+        await subtask(state)
+        remaining -= 1
+        if not remaining:
+            all_done.set()
+
+    for _ in range(subtasks):
+        asyncio.ensure_future(counted())
+    await all_done.wait()
+
+
+FAN_INS = [
+    ('ProcessWaiter', fan_in_process_waiter),
+    ('Instrumented', fan_in_instrumented),
+    ('FanOut', fan_in_fan_out),
+    ('FanOut limit=1000', fan_in_fan_out_limited),
+    ('gen.multi', fan_in_multi),
+    ('asyncio.gather', fan_in_gather),
+    ('counter+Event', fan_in_event),
+]
+
+
+async def bench_fan_in(subtask_counts, memory):
+    print('%-18s %9s %14s %14s %12s' % ('fan-in', 'subtasks', 'subtasks/sec', 'wake-up us', 'bytes/task'))
+    for subtasks in subtask_counts:
+        for name, fan_in in FAN_INS:
+            state = State()
+            gc.collect()
+            if memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            waiter = await fan_in(subtasks, state)
+            woken_at = time.perf_counter()
+            peak_memory = None
+            if memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print('%-18s %9d %14.0f %14.1f %12s' % (
+                name, subtasks, subtasks / (woken_at - start), (woken_at - state.last_done) * 1e6,
+                '-' if peak_memory is None else '%.0f' % (peak_memory / subtasks)))
+            if isinstance(waiter, InstrumentedProcessWaiter):
+                await asyncio.sleep(0)  # the waiter's done callbacks
+                stats = waiter.stats()
+                print('    peak concurrency %d, drained in %.1f ms, %d waits, max wait %.1f ms' % (
+                    stats['peak_concurrency'], stats['last_drain_time'] * 1000, stats['waits'],
+                    stats['max_wait_time'] * 1000))
+
+
+async def settle(futures):
+    for future in futures:
+        try:
+            await future
+        except (tornado.gen.TimeoutError, asyncio.CancelledError):
+            pass
+
+
+async def bench_timeouts_once(waiter_class, waiters, span):
+    io_loop = tornado.ioloop.IOLoop.current()
+    process_waiter = waiter_class()
+    process_waiter.processing()
+    now = io_loop.time()
+    deadlines = [now + span * i / waiters for i in range(waiters)]
+    random.shuffle(deadlines)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    futures = [process_waiter.wait_all_done(deadline) for deadline in deadlines]
+    registration = time.perf_counter() - start
+    peak_waiters = len(process_waiter._waiters)
+    await asyncio.sleep(max(now + span / 2 - io_loop.time(), 0))
+    peak_waiters = max(peak_waiters, len(process_waiter._waiters))
+    process_waiter.done()
+    await settle(futures)
+    # Leftover timers of the woken waiters still cost CPU until they fire.
+    await asyncio.sleep(max(now + span - io_loop.time(), 0) + 0.05)
+    timed_out = sum(1 for future in futures if future.exception() is not None)
+    return {
+        'register_us': registration / waiters * 1e6,
+        'cpu_ms': (time.process_time() - cpu_start) * 1000,
+        'peak_waiters': peak_waiters,
+        'timed_out': timed_out,
+    }
+
+
+async def bench_timeouts(waiter_counts, span):
+    print('%-20s %9s %12s %10s %13s %10s' % (
+        'implementation', 'waiters', 'register us', 'cpu ms', 'peak _waiters', 'timed out'))
+    for waiters in waiter_counts:
+        for name, waiter_class in (('legacy add_timeout', LegacyProcessWaiter), ('timer slots', ProcessWaiter)):
+            result = await bench_timeouts_once(waiter_class, waiters, span)
+            print('%-20s %9d %12.2f %10.1f %13d %10d' % (
+                name, waiters, result['register_us'], result['cpu_ms'], result['peak_waiters'],
+                result['timed_out']))
+
+
+async def check_round(waiters, errors):
+    io_loop = tornado.ioloop.IOLoop.current()
+    process_waiter = ProcessWaiter()
+    subtasks = random.randint(1, 20)
+    for _ in range(subtasks):
+        process_waiter.processing()
+    # The counter gets back to zero around `finish`, the deadlines are spread around it.
+    finish = random.uniform(0.005, 0.05)
+    lag = 0.02
+    entries = []
+    registered_at = io_loop.time()
+    for i in range(waiters):
+        deadline = registered_at + random.uniform(0, finish * 2) if random.random() < 0.9 else None
+        future = process_waiter.wait_all_done(deadline)
+        entries.append((future, deadline))
+        if random.random() < 0.05:
+            future.cancel()
+    for i in range(subtasks):
+        await asyncio.sleep(finish / subtasks)
+        process_waiter.done()
+    finished_at = io_loop.time()
+    for future, deadline in entries:
+        try:
+            await future
+        except asyncio.CancelledError:
+            continue
+        except tornado.gen.TimeoutError:
+            fired_at = io_loop.time()
+            if deadline is None:
+                errors.append('timed out without a deadline')
+            elif fired_at < deadline:
+                errors.append('timed out %.4fs early' % (deadline - fired_at))
+        else:
+            if deadline is not None and deadline + ProcessWaiter.timer_resolution + lag < finished_at:
+                errors.append('woken at %.4f, deadline %.4f passed' % (finished_at, deadline))
+    if process_waiter._waiters or process_waiter._slots or process_waiter._slot_heap or process_waiter._timer:
+        errors.append('state left: %r, %d slots' % (process_waiter, len(process_waiter._slots)))
+    # Let the leftover timers fire, errors in them reach the exception handler.
+    await asyncio.sleep(finish * 2)
+
+
+async def check_fan_out(errors):
+    io_loop = tornado.ioloop.IOLoop.current()
+    state = State()
+    for close in (False, True):
+        fan_out = FanOut(limit=3).map(subtask, itertools.repeat(state, 20))
+        async for _ in fan_out:
+            break
+        if close:
+            await fan_out.aclose()
+        try:
+            await fan_out.wait_all_done(io_loop.time() + 1)
+        except tornado.gen.TimeoutError:
+            errors.append('FanOut wait_all_done hangs after a break%s: %r' % (' and aclose()' if close else '', fan_out))
+            continue
+        # Unread results are still there to iterate over, unless closed.
+        left = [result async for result in fan_out]
+        if len(left) != (0 if close else 19):
+            errors.append('FanOut %d results left after a break%s' % (len(left), ' and aclose()' if close else ''))
+    for limit in (1, 10):
+        for iterate in (False, True):
+            fan_out = FanOut(limit=limit, waiter=InstrumentedProcessWaiter())
+            fan_out.map(subtask, itertools.repeat(state, 100))
+            if iterate:
+                async for _ in fan_out:
+                    pass
+            else:
+                await fan_out.wait_all_done()
+            peak = fan_out.waiter.peak_concurrency
+            if peak > limit:
+                errors.append('FanOut limit=%d counted %d subtasks at once%s' % (
+                    limit, peak, ' while iterated' if iterate else ''))
+    for limit in (0, -1):
+        try:
+            FanOut(limit=limit)
+        except ValueError:
+            pass
+        else:
+            errors.append('FanOut accepts limit=%d' % limit)
+
+
+async def check(rounds, waiters):
+    errors = []
+    loop = asyncio.get_event_loop()
+    loop.set_exception_handler(lambda loop, context: errors.append(context.get('message')))
+    await check_fan_out(errors)
+    for _ in range(rounds):
+        await check_round(waiters, errors)
+    for error in errors[:20]:
+        print('ERROR %s' % error)
+    print('%d rounds of %d waiters, %d errors' % (rounds, waiters, len(errors)))
+    return 1 if errors else 0
+
+
+def comma_list(convert=str):
+    return lambda value: [convert(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['fan-in', 'timeouts', 'check'])
+    parser.add_argument('--subtasks', type=comma_list(int), default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--memory', action='store_true', help='trace the peak memory with tracemalloc')
+    parser.add_argument('--waiters', type=comma_list(int), default=None)
+    parser.add_argument('--span', type=float, default=2, help='seconds the deadlines are spread over')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args(argv)
+    if args.benchmark == 'fan-in':
+        asyncio.run(bench_fan_in(args.subtasks, args.memory))
+        return 0
+    if args.benchmark == 'timeouts':
+        asyncio.run(bench_timeouts(args.waiters or [1000, 10000, 100000], args.span))
+        return 0
+    return asyncio.run(check(args.rounds, (args.waiters or [200])[0]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,32 @@
 # coding=utf-8
 """Wait for all subtasks have done.
 """
+import asyncio
+import collections
+import datetime
+import heapq
+import math
+import time
+
 import tornado
-import tornado.locks
+import tornado.gen
+import tornado.ioloop
+from tornado import gen
 from tornado.concurrent import Future
 
 
-class ProcessWaiter(tornado.locks._TimeoutGarbageCollector):
+class ProcessWaiter(object):
+    # Timeouts fire up to this many seconds late, the waiters whose deadlines
+    # fall into the same slot share one IOLoop timeout.
+    timer_resolution = 0.01
 
     def __init__(self):
-        super(ProcessWaiter, self).__init__()
         self._value = 0
+        self._waiters = collections.deque()
+        self._timed_out = 0  # waiters in _waiters that timed out
+        self._slots = {}  # slot: waiters with a deadline in it
+        self._slot_heap = []
+        self._timer = None  # (io_loop, slot, handle) of the earliest slot
 
     def __repr__(self):
         res = super(ProcessWaiter, self).__repr__()
@@ -37,26 +53,355 @@ class ProcessWaiter(tornado.locks._TimeoutGarbageCollector):
             # wake all waiters and release them
             while self._waiters:
                 waiter = self._waiters.popleft()
-                waiter.set_result(tornado.locks._ReleasingContextManager(waiter))
+                if not waiter.done():  # timed out
+                    waiter.set_result(None)
+            self._timed_out = 0
+            # Every waiter with a deadline is done now.
+            self._slots.clear()
+            del self._slot_heap[:]
+            if self._timer is not None:
+                self._timer[0].remove_timeout(self._timer[2])
+                self._timer = None
 
     def wait_all_done(self, timeout=None):
+        """A Future resolved once the counter is back to zero.
+
+        It fails with `tornado.gen.TimeoutError` at `timeout`, an
+        `IOLoop.time()` or a `datetime.timedelta` as for
+        `IOLoop.add_timeout`, within `timer_resolution`.
+        """
         waiter = Future()
         if self._value == 0:
-            waiter.set_result(tornado.locks._ReleasingContextManager(self))
+            waiter.set_result(None)
         elif self._value < 0:
             self._waiters.append(waiter)
             if timeout:
-                def on_timeout():
-                    waiter.set_exception(tornado.gen.TimeoutError())
-                    self._garbage_collect()
-                io_loop = tornado.ioloop.IOLoop.current()
-                timeout_handle = io_loop.add_timeout(timeout, on_timeout)
-                waiter.add_done_callback(
-                    lambda _: io_loop.remove_timeout(timeout_handle))
+                self._add_timeout(waiter, timeout)
         else:
             raise ProcessWaiterSemaphoreException('Semaphore value is positive (val:%d)' % self._value)
         return waiter
 
+    def _add_timeout(self, waiter, timeout):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if isinstance(timeout, datetime.timedelta):
+            timeout = io_loop.time() + timeout.total_seconds()
+        # Rounded up, never early.
+        slot = int(math.ceil(timeout / self.timer_resolution))
+        waiters = self._slots.get(slot)
+        if waiters is None:
+            waiters = self._slots[slot] = []
+            heapq.heappush(self._slot_heap, slot)
+            if self._timer is None or slot < self._timer[1]:
+                self._schedule(io_loop)
+        # Waiters done before their deadline stay here, _expire skips them.
+        waiters.append(waiter)
+
+    def _schedule(self, io_loop):
+        if self._timer is not None:
+            self._timer[0].remove_timeout(self._timer[2])
+        slot = self._slot_heap[0]
+        self._timer = (io_loop, slot, io_loop.call_at(slot * self.timer_resolution, self._expire))
+
+    def _expire(self):
+        io_loop = self._timer[0]
+        self._timer = None
+        now = io_loop.time()
+        while self._slot_heap and self._slot_heap[0] * self.timer_resolution <= now:
+            for waiter in self._slots.pop(heapq.heappop(self._slot_heap)):
+                if not waiter.done():
+                    waiter.set_exception(tornado.gen.TimeoutError())
+                    self._timed_out += 1
+        if self._slot_heap:
+            self._schedule(io_loop)
+        if self._timed_out * 2 > len(self._waiters):
+            self._waiters = collections.deque(waiter for waiter in self._waiters if not waiter.done())
+            self._timed_out = 0
+
+
+class InstrumentedProcessWaiter(ProcessWaiter):
+    """ProcessWaiter that records how it's used, ProcessWaiter itself pays nothing for it.
+
+    `peak_concurrency` is the most subtasks at once (a FanOut with a
+    backlog and nothing running counts one). A drain runs from the
+    first `processing()` to the counter getting back to zero: `drains`
+    counts them, `last_drain_time` and `max_drain_time` are their lengths.
+    `waits`, `wait_time_total` and `max_wait_time` cover the waiters of
+    `wait_all_done` once they're woken, timed out or cancelled, and
+    `timeouts` counts the timed out ones. `queued_waiters` is
+    `len(self._waiters)`.
+
+    Subclasses may override `on_processing`, `on_drained` and `on_waited`
+    to export them.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        super(InstrumentedProcessWaiter, self).__init__()
+        self.clock = clock
+        self.peak_concurrency = 0
+        self.drains = 0
+        self.last_drain_time = 0.0
+        self.max_drain_time = 0.0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self._busy_since = None
+
+    @property
+    def queued_waiters(self):
+        return len(self._waiters)
+
+    def processing(self):
+        if self._value == 0:
+            self._busy_since = self.clock()
+        super(InstrumentedProcessWaiter, self).processing()
+        if -self._value > self.peak_concurrency:
+            self.peak_concurrency = -self._value
+        self.on_processing()
+
+    def done(self):
+        super(InstrumentedProcessWaiter, self).done()
+        if self._value == 0 and self._busy_since is not None:
+            self.drains += 1
+            self.last_drain_time = self.clock() - self._busy_since
+            self.max_drain_time = max(self.max_drain_time, self.last_drain_time)
+            self._busy_since = None
+            self.on_drained(self.last_drain_time)
+
+    def wait_all_done(self, timeout=None):
+        waiter = super(InstrumentedProcessWaiter, self).wait_all_done(timeout)
+        started_at = self.clock()
+
+        def waited(future):
+            wait_time = self.clock() - started_at
+            timed_out = not future.cancelled() and future.exception() is not None
+            self.waits += 1
+            self.wait_time_total += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.timeouts += timed_out
+            self.on_waited(wait_time, timed_out)
+        waiter.add_done_callback(waited)
+        return waiter
+
+    def on_processing(self):
+        pass
+
+    def on_drained(self, drain_time):
+        pass
+
+    def on_waited(self, wait_time, timed_out):
+        pass
+
+    def stats(self):
+        return {
+            'in_flight': -self._value,
+            'peak_concurrency': self.peak_concurrency,
+            'queued_waiters': self.queued_waiters,
+            'drains': self.drains,
+            'last_drain_time': self.last_drain_time,
+            'max_drain_time': self.max_drain_time,
+            'waits': self.waits,
+            'mean_wait_time': self.wait_time_total / self.waits if self.waits else 0.0,
+            'max_wait_time': self.max_wait_time,
+            'timeouts': self.timeouts,
+        }
+
+
+class FanOut(object):
+    """Run subtasks at most `limit` at a time, the results come back in completion order.
+
+    `submit` takes an awaitable (a coroutine, an asyncio or Tornado future,
+    anything `gen.convert_yielded` accepts), `map(fn, items)` calls `fn` on
+    the items lazily, as slots free up, so the cost per subtask stays
+    constant whatever their number. A subtask is started once one of the
+    `limit` slots is free: it's running, or its result waits to be iterated
+    over, so a slow consumer holds the subtasks back. `limit=None` starts
+    everything at once.
+
+        fan_out = FanOut(limit=100)
+        async for balance in fan_out.map(fetch_balance, wallets):
+            ...
+
+    With `fail_fast`, the first error cancels everything else and is raised
+    by the iterator and `wait_all_done`. Otherwise failed subtasks are left
+    out of the results, and a FanOutError with all the errors is raised once
+    the rest is done.
+
+    Unread results don't hold the subtasks back while `wait_all_done` waits,
+    so it's fine to break out of the loop and wait for the rest. `aclose()`
+    stops iterating for good, dropping the unread results.
+    """
+    _exhausted = object()
+
+    def __init__(self, limit=None, fail_fast=False, waiter=None):
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be at least 1 (val:{0!r})'.format(limit))
+        self.limit = limit
+        self.fail_fast = fail_fast
+        # e.g. an InstrumentedProcessWaiter
+        self.waiter = ProcessWaiter() if waiter is None else waiter
+        self.errors = []
+        self._backlog = collections.deque()  # (None, awaitable) or (fn, iterator of args)
+        self._running = set()
+        self._results = collections.deque()
+        self._keep_results = True
+        self._iterating = False
+        self._draining = 0  # wait_all_done calls waiting
+        self._holding = False
+        self._failed = None
+        self._next = None
+
+    def __repr__(self):
+        return '<{0} running:{1},results:{2},errors:{3}>'.format(
+            self.__class__.__name__, len(self._running), len(self._results), len(self.errors))
+
+    def submit(self, awaitable):
+        self._backlog.append((None, awaitable))
+        self._fill()
+        return self
+
+    def map(self, fn, *iterables):
+        self._backlog.append((fn, zip(*iterables)))
+        self._fill()
+        return self
+
+    def cancel(self):
+        """Drop the subtasks not started yet and cancel the running ones."""
+        self._backlog.clear()
+        for future in list(self._running):
+            future.cancel()
+        self._fill()
+
+    def _has_slot(self):
+        if self._failed is not None:
+            return False
+        if self.limit is None:
+            return True
+        busy = len(self._running)
+        if self._keep_results and not self._draining:
+            busy += len(self._results)
+        return busy < self.limit
+
+    def _take(self):
+        while self._backlog:
+            fn, args = self._backlog[0]
+            if fn is None:
+                self._backlog.popleft()
+                return args
+            for item in args:
+                return fn(*item)
+            self._backlog.popleft()
+        return self._exhausted
+
+    def _fill(self):
+        if self._failed is not None:
+            self._backlog.clear()
+        while self._backlog and self._has_slot():
+            try:
+                awaitable = self._take()
+                if awaitable is self._exhausted:
+                    break
+                future = asyncio.ensure_future(gen.convert_yielded(awaitable))
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            self._running.add(future)
+            if self._holding:
+                # Takes over the count of the backlog.
+                self._holding = False
+            else:
+                self.waiter.processing()
+            future.add_done_callback(self._on_done)
+        # With nothing running, the backlog keeps the waiter from reaching zero.
+        hold = bool(self._backlog) and not self._running
+        if hold != self._holding:
+            self._holding = hold
+            if hold:
+                self.waiter.processing()
+            else:
+                self.waiter.done()
+
+    def _on_done(self, future):
+        self._running.discard(future)
+        if not future.cancelled():
+            error = future.exception()
+            if error is None:
+                if self._keep_results:
+                    self._results.append(future.result())
+            elif not self.fail_fast:
+                self.errors.append(error)
+            elif self._failed is None:
+                self._failed = error
+                self.cancel()
+        # Free the slot before starting the next ones, so the waiter never
+        # counts more than `limit`.
+        if self._backlog and not self._running and not self._holding:
+            # The last one's count holds the backlog, the waiter mustn't see zero.
+            self._holding = True
+        else:
+            self.waiter.done()
+        self._fill()
+        if self._next is not None:
+            if not self._next.done():
+                self._next.set_result(None)
+            self._next = None
+
+    def _raise_errors(self):
+        if self._failed is not None:
+            raise self._failed
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise FanOutError(errors)
+
+    def __aiter__(self):
+        self._iterating = True
+        return self
+
+    async def __anext__(self):
+        while not self._results or self._failed is not None:
+            if self._failed is not None or (not self._running and not self._backlog):
+                self._raise_errors()
+                raise StopAsyncIteration
+            self._next = Future()
+            await self._next
+        result = self._results.popleft()
+        self._fill()
+        return result
+
+    async def aclose(self):
+        """Stop iterating: the unread results are dropped, the subtasks keep running."""
+        self._iterating = False
+        self._keep_results = False
+        self._results.clear()
+        self._fill()
+
+    async def wait_all_done(self, deadline=None):
+        """Wait for the subtasks submitted so far.
+
+        Results nobody iterates over are dropped, those of an iteration
+        stay for it but don't take up slots meanwhile. Raises as the iterator
+        does, or `tornado.gen.TimeoutError` at `deadline` (an `IOLoop.time()`
+        or a `datetime.timedelta`), the subtasks keep running then.
+        """
+        if not self._iterating:
+            self._keep_results = False
+            self._results.clear()
+        self._draining += 1
+        try:
+            self._fill()
+            await self.waiter.wait_all_done(deadline)
+        finally:
+            self._draining -= 1
+        self._raise_errors()
+
 
 class ProcessWaiterSemaphoreException(Exception):
     pass
+
+
+class FanOutError(Exception):
+    """The errors of the failed subtasks of a FanOut, in completion order."""
+
+    def __init__(self, errors):
+        super(FanOutError, self).__init__('{0} subtasks failed, first: {1!r}'.format(len(errors), errors[0]))
+        self.errors = errors